@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+"""Scripted checks of the Python API of Thot, run by test.py
+(one check per label given on the command line)."""
+import io
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import thot.backs.html as bhtml
+import thot.common as common
+import thot.db as db
+import thot.diff as diff
+import thot.doc as doc
+import thot.serial as serial
+from thot.stats import Stats
+import thot.tparser as tparser
+import thot.ui as ui
+
+DOC = "dokuwiki.thot"
+
+
+def parse(path = DOC, lazy = False, text = None):
+	"""Parse the document at the given path or, if text is given,
+	this text in place of the content of the file."""
+	base = db.DB()
+	base["THOT_OUT_PATH"] = ""
+	base["THOT_DOC_DIR"] = "."
+	document = doc.Document(base)
+	document["THOT_FILE"] = path
+	if text is None:
+		with open(path) as input:
+			text = input.read()
+	tparser.Manager(document, base, lazy).parse(io.StringIO(text), path)
+	return document
+
+
+def read(path = DOC):
+	with open(path) as input:
+		return input.read()
+
+
+def count_nodes(document):
+	stats = Stats()
+	stats.collect(document)
+	return stats.nodes
+
+
+def check_freeze():
+	document = parse()
+	count = count_nodes(document)
+	document.freeze()
+	assert document.frozen
+	for node in document.nodes:
+		if node is not None and isinstance(node, doc.Container):
+			assert node.content.__class__ is tuple, node
+	assert count_nodes(document) == count, (count_nodes(document), count)
+	empty = doc.Par()
+	empty.content = ()
+	assert empty.isEmpty()
+	assert not document.isEmpty()
+
+
+def check_diff():
+	assert diff.diff(parse(), parse()).is_empty()
+	assert diff.diff(parse(), parse(lazy = True)).is_empty()
+
+	# modified paragraph
+	text = read()
+	changes = diff.diff(parse(), parse(text = text.replace("bare URL", "naked URL"))).get_changes()
+	assert [c.kind for c in changes] == [diff.MODIFIED], len(changes)
+
+	# moved paragraph
+	pars = ["paragraph %d\n\n" % i for i in range(3000)]
+	old = parse(text = "@use dokuwiki\n" + "".join(pars))
+	pars.append(pars.pop(0))
+	changes = diff.diff(old, parse(text = "@use dokuwiki\n" + "".join(pars))).get_changes()
+	assert [c.kind for c in changes] == [diff.MOVED], len(changes)
+
+	# paragraph inserted among many identical ones
+	text = "@use dokuwiki\n" + "same paragraph\n\n" * 3000
+	changes = diff.diff(parse(text = text), parse(text = text + "same paragraph\n")).get_changes()
+	assert [c.kind for c in changes] == [diff.INSERTED], len(changes)
+
+
+class HeaderCounter(doc.Visitor):
+
+	def __init__(self, prune = False):
+		self.prune = prune
+		self.headers = []
+		self.ends = 0
+
+	def onHeader(self, node):
+		self.headers.append(node)
+		if self.prune:
+			return doc.PRUNE
+
+	def endHeader(self, node):
+		self.ends += 1
+
+
+class Stopper(doc.Visitor):
+
+	def __init__(self):
+		self.count = 0
+
+	def onWord(self, node):
+		self.count += 1
+		return doc.STOP
+
+
+def check_visitor():
+	document = parse()
+	headers = [entry.node for entry in document.get_headers()]
+	visitor = HeaderCounter()
+	visitor.walk(document)
+	assert visitor.headers == headers
+	assert visitor.ends == len(headers)
+	visitor = HeaderCounter(True)
+	visitor.walk(document)
+	assert visitor.headers == [n for n in headers if n.getHeaderLevel() == 0]
+	assert visitor.ends == 0
+	visitor = Stopper()
+	visitor.walk(document)
+	assert visitor.count == 1
+
+
+def check_find():
+	document = parse()
+	headers = [entry.node for entry in document.get_headers()]
+	assert document.find(doc.Header) == headers
+	words = document.find(doc.Word)
+	assert words and all(isinstance(w, doc.Word) for w in words)
+	chapter = headers[-1]
+	inside = document.find(doc.Word, chapter)
+	assert inside and set(map(id, inside)) < set(map(id, words))
+	for word in inside:
+		node = word.parent
+		while node is not chapter:
+			assert node is not None, word
+			node = node.parent
+	lazy = parse(lazy = True)
+	assert len(lazy.find(doc.Word)) == len(words)
+
+
+def check_stream():
+	for (mode, page, path) in [
+		("document", 0, "dokuwiki.html"),
+		("chapter", 2, "dokuwiki-1.html")
+	]:
+		document = parse()
+		document["HTML_ONE_FILE_PER"] = mode
+		data = b"".join(bhtml.stream(document, ui.DEF, page))
+		document = parse()
+		document["HTML_ONE_FILE_PER"] = mode
+		bhtml.output(document, ui.DEF)
+		with open(path, "rb") as input:
+			assert data == input.read(), path
+
+	# stop after the first chunk
+	document = parse()
+	chunks = bhtml.stream(document, ui.DEF, 0, 16)
+	assert next(chunks)
+	chunks.close()
+
+
+def check_toc():
+	pages = { }
+	for lazy in (False, True):
+		document = parse(lazy = lazy)
+		document["HTML_ONE_FILE_PER"] = "chapter"
+		built = []
+		init = bhtml.TocFragments.__init__
+		def record(self, *args):
+			built.append(self)
+			init(self, *args)
+		bhtml.TocFragments.__init__ = record
+		try:
+			bhtml.output(document, ui.DEF)
+		finally:
+			bhtml.TocFragments.__init__ = init
+		assert len(built) == 1, len(built)
+		for path in ["dokuwiki.html"] + ["dokuwiki-%d.html" % i for i in range(4)]:
+			with open(path, "rb") as input:
+				data = input.read()
+			assert pages.setdefault(path, data) == data, path
+
+
+def check_terms():
+	document = parse(lazy = True)
+	assert document.resolve_hash("hashed") is None
+	ref = document.resolve_hash("glossary")
+	assert isinstance(ref, doc.TermRef) and ref.term == "glossary"
+	assert not document.is_materialized()
+	definition = document.get_term("glossary")
+	assert isinstance(definition, doc.Tag) and definition.tag == "glossary"
+	assert parse().get_term("glossary").get_location() == definition.get_location()
+
+
+def check_mount():
+	document = parse()
+	part = parse()
+	table = part.get_label("table")
+	document.mount(part)
+	assert document.get_label("dokuwiki:table") is table
+	assert document.get_label("table") is not table
+	for (label, node) in document.labels.items():
+		assert document.get_label_for(node) == label, label
+	labels = [ref.label for ref in document.find(doc.Ref)]
+	assert labels == ["table", "dokuwiki:table"], labels
+
+	# second collision
+	part = parse()
+	part.add_label("dokuwiki:table", part.get_label("table"))
+	try:
+		document.mount(part)
+		assert False
+	except common.ThotException:
+		pass
+
+
+class Trickle(io.RawIOBase):
+	"""Binary stream returning at most 7 bytes per read."""
+
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+
+	def readable(self):
+		return True
+
+	def read(self, n = -1):
+		res = self.data[self.pos:self.pos + min(n, 7)]
+		self.pos += len(res)
+		return res
+
+
+def check_serial():
+	document = parse()
+	data = serial.dumps(document)
+	assert serial.dumps(serial.loads(data, document.db)) == data
+	assert serial.dumps(serial.load(Trickle(data), document.db)) == data
+	for size in (5, 100, len(data) // 2, len(data) - 1):
+		try:
+			serial.loads(data[:size], document.db)
+			assert False, size
+		except common.ThotException:
+			pass
+
+
+CHECKS = {
+	"diff": check_diff,
+	"find": check_find,
+	"freeze": check_freeze,
+	"mount": check_mount,
+	"serial": check_serial,
+	"stream": check_stream,
+	"terms": check_terms,
+	"toc": check_toc,
+	"visitor": check_visitor
+}
+
+
+if __name__ == "__main__":
+	for label in sys.argv[1:]:
+		CHECKS[label]()
+		sys.stderr.write("%s checked\n" % label)
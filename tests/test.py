@@ -1,4 +1,6 @@
 #!/usr/bin/python3
+import os
+import os.path
 import subprocess
 import sys
 
@@ -6,21 +8,35 @@ THOT = "../thot.py"
 
 class Test:
 
-	def __init__(self, label, file = None, params = ""):
+	def __init__(self, label, file = None, params = "", path = None):
 		self.label = label
 		if file == None:
 			self.file = label + ".thot"
 		else:
 			self.file = file
 		self.params = params
+		self.path = path
+
+	def get_command(self):
+		"""Get the command performing the test."""
+		return "%s %s %s" % (THOT, self.file, self.params)
+
+	def get_env(self):
+		"""Get the environment of the test: path is a directory
+		looked up first for the commands."""
+		if self.path == None:
+			return None
+		env = dict(os.environ)
+		env["PATH"] = os.path.abspath(self.path) + os.pathsep + env["PATH"]
+		return env
 
 	def process(self, dump = False):
 		sys.stderr.write("%s ....\n" % self.label)
 		sys.stderr.flush()
 		ret = subprocess.run(
-			"%s %s %s 2> %s.log" % \
-				(THOT, self.file, self.params, self.label),
-			shell=True
+			"%s 2> %s.log" % (self.get_command(), self.label),
+			shell=True,
+			env=self.get_env()
 		)
 		if ret.returncode == 0:
 			sys.stderr.write("%s ... [OK]\n" % self.label)
@@ -36,10 +52,39 @@ class Test:
 					% (self.label, self.label))
 			return False
 
+class Check(Test):
+	"""Test running the check of the given label in check.py."""
+
+	def __init__(self, label, check):
+		Test.__init__(self, label)
+		self.check = check
+
+	def get_command(self):
+		return "%s check.py %s" % (sys.executable, self.check)
+
+
 ALL = [
 	Test("html-all", "dokuwiki.thot"),
 	Test("html-chapter", "dokuwiki.thot", "-DHTML_ONE_FILE_PER=chapter"),
 	Test("html-section", "dokuwiki.thot", "-DHTML_ONE_FILE_PER=section"),
+	Test("html-jobs", "dokuwiki.thot", "-DHTML_ONE_FILE_PER=section -j 2"),
+	Test("html-lazy", "dokuwiki.thot", "-DHTML_ONE_FILE_PER=chapter --lazy"),
+	Test("html-highlight", "dokuwiki.thot", "-DHTML_ONE_FILE_PER=chapter", "stub"),
+	Test("html-gzip", "dokuwiki.thot", "-DHTML_ONE_FILE_PER=chapter -DHTML_PRECOMPRESS=yes"),
+	Test("html-template", "dokuwiki.thot", "-DHTML_ONE_FILE_PER=chapter -DHTML_TEMPLATE=template.html -DAUTHORS=\"A. Writer <a@b.org>, B. Writer\""),
+	Test("emit-ast", "dokuwiki.thot", "--emit-ast dokuwiki.ast"),
+	Test("from-ast", "dokuwiki.ast", "--from-ast"),
+	Test("book", "dokuwiki.thot", "--book dokuwiki.ast"),
+	Test("stats", "dokuwiki.thot", "--stats"),
+	Check("check-diff", "diff"),
+	Check("check-visitor", "visitor"),
+	Check("check-find", "find"),
+	Check("check-freeze", "freeze"),
+	Check("check-mount", "mount"),
+	Check("check-serial", "serial"),
+	Check("check-stream", "stream"),
+	Check("check-terms", "terms"),
+	Check("check-toc", "toc"),
 #	Test("simple-html", "simple.thot"),
 #	Test("simple-latex", "simple.thot", "-t latex"),	
 #	Test("simple-docbook", "simple.thot", "-t docbook"),
@@ -141,7 +141,7 @@ class BackEnd:
 			try:
 				os.makedirs(dpath)
 			except os.error as e:
-				common.onError('cannot create directory "%s": %s' % (dpath, e))
+				raise common.BackException('cannot create directory "%s": %s' % (dpath, e))
 		
 		# ensure uniqueness
 		file, ext = os.path.splitext(path)
@@ -168,9 +168,9 @@ class BackEnd:
 			shutil.copyfile(spath, tpath)
 			return tpath
 		except shutil.Error as e:
-			common.onError('can not copy "%s" to "%s": %s' % (spath, tpath, str(e)))
+			raise common.BackException('can not copy "%s" to "%s": %s' % (spath, tpath, str(e)))
 		except IOError as e:
-			common.onError('can not copy "%s" to "%s": %s' % (spath, tpath, str(e)))
+			raise common.BackException('can not copy "%s" to "%s": %s' % (spath, tpath, str(e)))
 
 
 	def use_friend(self, path, base = ''):
@@ -17,19 +17,28 @@
 
 """Standard HTML back-end."""
 
+import concurrent.futures
 from glob import iglob as glob
+import gzip
 import html as my_html
+import io
+import multiprocessing
 import os
 import os.path
+import queue
 import re
 import shutil
 import sys
+import threading
 import urllib.parse as urlparse
 
 import thot.common as common
 import thot.doc as doc
 import thot.html as html
 from thot import i18n
+import thot.manifest as manifest
+import thot.numbering as numbering
+import thot.pages as pages
 
 
 
@@ -78,13 +87,249 @@ class PageHandler:
 		"""Get the reference to the given node."""
 		return None
 
+	def get_remote_ref(self, node):
+		"""Get the reference to the given node from a page that does
+		not contain it."""
+		return self.get_ref(node)
+
+	def get_anchor_ref(self, node, anchor):
+		"""Get the reference to an anchor put in the page containing
+		the given node."""
+		return "#" + anchor
+
+	def get_remote_anchor_ref(self, node, anchor):
+		"""Get the reference to an anchor put in the page containing
+		the given node from a page that does not contain it."""
+		return self.get_anchor_ref(node, anchor)
+
+	def is_local(self, node):
+		"""Test if the node is in the current page."""
+		return True
+
 	def write(self, text):
 		"""Output the given text."""
 		pass
 
 
+class Capture:
+	"""Handler collecting the written text instead of outputting it.
+	Other services are delegated to the captured handler. If remote
+	is True, the references are obtained as from another page."""
+
+	def __init__(self, handler, remote = False):
+		self.handler = handler
+		self.remote = remote
+		self.buf = []
+
+	def write(self, text):
+		self.buf.append(text)
+
+	def get_writer(self):
+		return self.buf.append
+
+	def get_ref(self, node):
+		if self.remote:
+			return self.handler.get_remote_ref(node)
+		else:
+			return self.handler.get_ref(node)
+
+	def get_anchor_ref(self, node, anchor):
+		if self.remote:
+			return self.handler.get_remote_anchor_ref(node, anchor)
+		else:
+			return self.handler.get_anchor_ref(node, anchor)
+
+	def add_footnote(self, note):
+		return None
+
+	def get_text(self):
+		"""Get the text written since the last call."""
+		text = "".join(self.buf)
+		self.buf = []
+		return text
+
+	def __getattr__(self, name):
+		return getattr(self.handler, name)
+
+
+class TocFragments:
+	"""Table of content rendered once in HTML fragments, for a given
+	expansion level, and stitched together for each page. The fragments
+	are rendered as seen from another page than the one of the headers
+	and are indexed by header entry:
+	* items -- opening of the item with the link to the header,
+	* closed -- item without the sub-headers,
+	* subs -- list of the sub-headers expanded to the level (or ""),
+	* opened -- item with the sub-headers if its level is less than
+	  the expansion level.
+	The headers of the current page (see PageHandler.is_local()) are
+	rendered again. As the pages are nested, the sub-headers of a header
+	outside of the current page are also outside of the current page.
+
+	When delayed bodies are built, their headers are inserted in the
+	header index: extend() renders only the new headers and the
+	sub-trees of the top-level headers containing them."""
+
+	def __init__(self, page, handler, level, indent):
+		self.page = page
+		self.doc = handler.get_doc()
+		self.indent = indent
+		self.level = level
+		self.indents = { }
+		self.children = { }
+		self.items = { }
+		self.closed = { }
+		self.subs = { }
+		self.opened = { }
+		headers = self.doc.get_headers()
+		self.count = len(headers)
+		self.top = list(self.doc.get_header_children(None))
+		self.sizes = { }
+		for entry in self.top:
+			self.sizes[entry] = entry.end - entry.index
+		self.render(handler, headers)
+		self.build(headers)
+
+	def render(self, handler, entries):
+		"""Render the items of the given entries (in document order)."""
+		capture = Capture(handler, True)
+		for entry in entries:
+			if entry.parent is None:
+				ind = self.indent
+			else:
+				ind = self.indents[entry.parent] + "  "
+			self.indents[entry] = ind
+			capture.write("%s<li>\n" % ind)
+			self.page.gen_toc_entry(capture, entry.node, ind)
+			self.items[entry] = capture.get_text()
+			self.closed[entry] = self.items[entry] + "%s</li>\n" % ind
+
+	def build(self, entries):
+		"""Build the expanded sub-trees of the given entries (in
+		document order), bottom-up."""
+		for entry in reversed(entries):
+			children = list(self.doc.get_header_children(entry))
+			self.children[entry] = children
+			if children:
+				sub = self.indents[entry] + "  "
+				self.subs[entry] = '%s<ul class="toc">\n%s%s</ul>\n' % (sub,
+					"".join([self.opened[e] for e in children]), sub)
+			else:
+				self.subs[entry] = ""
+			if entry.level < self.level:
+				self.opened[entry] = self.items[entry] + self.subs[entry] + "%s</li>\n" % self.indents[entry]
+			else:
+				self.opened[entry] = self.closed[entry]
+
+	def extend(self, handler):
+		"""Render the headers added to the header index since the
+		fragments were rendered, that is, the headers of the bodies
+		built since then. As a body belongs to a top-level header,
+		only the sub-trees of the top-level headers that grew are
+		built again."""
+		headers = self.doc.get_headers()
+		for entry in self.top:
+			size = entry.end - entry.index
+			if size != self.sizes[entry]:
+				self.sizes[entry] = size
+				entries = headers[entry.index:entry.end]
+				self.render(handler, [e for e in entries if e not in self.items])
+				self.build(entries)
+		self.count = len(headers)
+
+	def get_item(self, handler, entry):
+		"""Get the opening of the item of the entry."""
+		if handler.is_local(entry.node):
+			capture = Capture(handler)
+			ind = self.indents[entry]
+			capture.write("%s<li>\n" % ind)
+			self.page.gen_toc_entry(capture, entry.node, ind)
+			return capture.get_text()
+		else:
+			return self.items[entry]
+
+	def get_closed(self, handler, entries):
+		"""Get the items of the given entries without sub-headers."""
+		res = []
+		is_local = handler.is_local
+		for entry in entries:
+			if is_local(entry.node):
+				res.append(self.get_item(handler, entry))
+				res.append("%s</li>\n" % self.indents[entry])
+			else:
+				res.append(self.closed[entry])
+		return "".join(res)
+
+	def get_opened(self, handler, entries, indent):
+		"""Get the list of the given entries with their sub-headers
+		expanded to the level."""
+		if not entries:
+			return ""
+		res = ['%s<ul class="toc">\n' % indent]
+		stack = [(iter(entries), indent)]
+		while stack:
+			children, ind = stack[-1]
+			for entry in children:
+				if not handler.is_local(entry.node):
+					res.append(self.opened[entry])
+					continue
+				res.append(self.get_item(handler, entry))
+				if entry.level < self.level and self.children[entry]:
+					sub = self.indents[entry] + "  "
+					res.append('%s<ul class="toc">\n' % sub)
+					stack.append((iter(self.children[entry]), sub))
+					break
+				res.append("%s</li>\n" % self.indents[entry])
+			else:
+				stack.pop()
+				res.append('%s</ul>\n' % ind)
+				if stack:
+					res.append("%s</li>\n" % ind[:-2])
+		return "".join(res)
+
+	def get_toc(self, handler, path):
+		"""Get the HTML of the table of content expanded along the given
+		path of headers: the headers of the path are opened and the last
+		one is expanded recursively until the level. An empty path
+		expands the whole content until the level."""
+		if not path:
+			return self.get_opened(handler, self.top, self.indent)
+		head = []
+		tail = []
+		entries = self.top
+		indent = self.indent
+		for (i, node) in enumerate(path):
+			if not entries:
+				break
+			for (j, entry) in enumerate(entries):
+				if entry.node is node:
+					break
+			else:
+				head.append('%s<ul class="toc">\n%s%s</ul>\n' % (indent,
+					self.get_closed(handler, entries), indent))
+				break
+			head.append('%s<ul class="toc">\n%s%s' % (indent,
+				self.get_closed(handler, entries[:j]),
+				self.get_item(handler, entry)))
+			tail.append('%s</li>\n%s%s</ul>\n' % (self.indents[entry],
+				self.get_closed(handler, entries[j + 1:]), indent))
+			if i == len(path) - 1:
+				if entry.level < self.level:
+					if handler.is_local(node):
+						head.append(self.get_opened(handler,
+							self.children[entry], self.indents[entry] + "  "))
+					else:
+						head.append(self.subs[entry])
+			else:
+				entries = self.children[entry]
+				indent = self.indents[entry] + "  "
+		tail.reverse()
+		return "".join(head) + "".join(tail)
+
+
 class Page:
 	"""Abstract class for page generation."""
+	toc_fragments = None
 
 	def gen_toc_entry(self, handler, node, indent):
 		"""Generate a content entry (including numbering, title and link)."""
@@ -95,52 +340,30 @@ class Page:
 		html.gen_container(handler, node.get_title())
 		handler.write('</a>\n')
 
-	def expand_toc(self, handler, node, level, indent):
-		"""Expand recursively the content and to the given level."""
-		if node.getHeaderLevel() >= level:
-			return
-		one = False
-		for child in node.getContent():
-			if child.getHeaderLevel() >= 0:
-				if not one:
-					one = True
-					handler.write('%s<ul class="toc">\n' % indent)
-				handler.write("%s<li>\n" % indent)
-				self.gen_toc_entry(handler, child, indent)
-				self.expand_toc(handler, child, level, indent + "  ")
-				handler.write("%s</li>\n" % indent)
-		if one:
-			handler.write('%s</ul>\n' % indent)
-
-	def expand_toc_to(self, handler, node, path, level, indent):
-		"""Expand, not recursively, the content until reaching the end of the path.
-		From this, expand recursively the sub-nodes."""
-		if not path:
-			self.expand_toc(handler, node, level, indent)
-		else:
-			one = False
-			for child in node.getContent():
-				if child.getHeaderLevel() >= 0:
-					if not one:
-						one = True
-						handler.write('%s<ul class="toc">\n' % indent)
-					handler.write("%s<li>\n" % indent)
-					self.gen_toc_entry(handler, child, indent)
-					if path[0] == child:
-						self.expand_toc_to(handler, child, path[1:], level, indent + '  ')
-					handler.write("%s</li>\n" % indent)
-			if one:
-				handler.write('%s</ul>\n' % indent)
-				
 	def gen_toc(self, handler, path = [], level = 100):
 		"""Generate the content without expanding until reaching the path
 		(of headers) with an expanding maximum level.
 		"""
 		handler.write('<div class="toc">\n')
 		handler.write('<h1><a name="toc">' + html.escape_cdata(handler.get_toc_label()) + '</name></h1>\n')
-		self.expand_toc_to(handler, handler.get_doc(), path, level, '  ')
+		handler.write(self.get_toc_fragments(handler, level).get_toc(handler, path))
 		handler.write('</div>\n')
 
+	def get_toc_fragments(self, handler, level):
+		"""Get the fragments of the table of content for the given
+		level, rendered the first time they are requested. As the header
+		index only grows (when delayed bodies are built), the fragments
+		are extended if the number of headers changed."""
+		if self.toc_fragments is None:
+			self.toc_fragments = { }
+		fragments = self.toc_fragments.get(level)
+		if fragments is None:
+			fragments = TocFragments(self, handler, level, '  ')
+			self.toc_fragments[level] = fragments
+		elif fragments.count != len(handler.get_doc().get_headers()):
+			fragments.extend(handler)
+		return fragments
+
 	def gen_authors(self, authors, handler):
 		"""Generate the list of authors."""
 		if authors:
@@ -150,14 +373,14 @@ class Page:
 				if first:
 					first = False
 				else:
-					self.out.write(', ')
+					handler.write(', ')
 				email = ""
 				if 'email' in author:
 					email = author['email']
-					out.write('<a href="mailto:' + escape_attr(email) + '">')
-				out.write(html.escape_cdata(author['name']))
+					handler.write('<a href="mailto:' + html.escape_attr(email) + '">')
+				handler.write(html.escape_cdata(author['name']))
 				if email:
-					out.write('</a>')		
+					handler.write('</a>')
 
 	def apply(self, handler):
 		"""Called to generate a page."""
@@ -215,56 +438,190 @@ class PlainPage(Page):
 
 template_re = re.compile("<thot:([^/]+)\/>")
 
+def gen_template_title(page, handler):
+	title = handler.get_title()
+	if title:
+		handler.write(html.escape_cdata(title))
+
+def gen_template_authors(page, handler):
+	page.gen_authors(handler.get_authors(), handler)
+
+def gen_template_toc(page, handler):
+	handler.gen_toc()
+
+def gen_template_content(page, handler):
+	handler.gen_content()
+	handler.gen_footnotes()
+
+def gen_template_header(page, handler):
+	handler.gen_head()
+
+TEMPLATE_ELEMENTS = {
+	"authors": 	gen_template_authors,
+	"content": 	gen_template_content,
+	"header":  	gen_template_header,
+	"title":   	gen_template_title,
+	"toc": 		gen_template_toc
+}
+
 class TemplatePage(Page):
 	"""Page supporting template in HTML. The template may contain
 	the following special elements:
-	* <thot:title> -- document title,
-	* <thot:authors> -- list of authors,
-	* <thot:menu> -- table of content of the document,
-	* <thot:content> -- content of the document.
-	"""
+	* <thot:title/> -- document title,
+	* <thot:authors/> -- list of authors,
+	* <thot:header/> -- additional content of the HTML header,
+	* <thot:toc/> -- table of content of the document,
+	* <thot:content/> -- content of the document.
+
+	The template is read and compiled the first time it is applied
+	into a list of literal texts and element functions. It is only
+	read again if its modification time changes."""
 	path = None
 	
 	def __init__(self, path):
 		self.path = path
+		self.mtime = None
+		self.segments = None
+
+	def compile(self, text):
+		"""Compile the template text into a list of segments."""
+		segments = []
+		f = 0
+		for m in template_re.finditer(text):
+			kw = m.group(1)
+			try:
+				fun = TEMPLATE_ELEMENTS[kw]
+			except KeyError:
+				raise common.BackException("%s:%d: unknown element %s" %
+					(self.path, text.count("\n", 0, m.start()) + 1, kw))
+			if f < m.start():
+				segments.append(text[f:m.start()])
+			segments.append(fun)
+			f = m.end()
+		if f < len(text):
+			segments.append(text[f:])
+		return segments
+
+	def load(self, handler):
+		"""Get the compiled template, reading it if it is not loaded
+		or has changed."""
+		try:
+			mtime = os.stat(self.path).st_mtime_ns
+			if self.segments is None or mtime != self.mtime:
+				encoding = handler.get_encoding()
+				if not encoding:
+					encoding = "UTF-8"
+				with open(self.path, encoding = str(encoding)) as input:
+					self.segments = self.compile(input.read())
+				self.mtime = mtime
+		except OSError as e:
+			raise common.BackException(str(e))
+		return self.segments
 
-	def apply(self, handler, out):
-		map = {
-			"authors": 	self.gen_authors,
-			"content": 	handler.gen_content,
-			"header":  	handler.gen_head,
-			"title":   	self.gen_title,
-			"toc": 		handler.gen_toc
-		}
-		global template_re
+	def apply(self, handler):
+		write = handler.get_writer()
+		for segment in self.load(handler):
+			if segment.__class__ is str:
+				write(segment)
+			else:
+				segment(self, handler)
 
-		try:
-			tpl = open(self.path, "r")
-			n = 0
-			for line in tpl.readlines():
-				n = n + 1
-				f = 0
-				for m in template_re.finditer(line):
-					gen.out.write(line[f:m.start()])
-					f = m.end()
-					try:
-						kw = m.group(1)
-						map[kw](out)
-					except KeyError as e:
-						common.onError("unknown element %s at %d" % (kw, n))					
-				gen.out.write(line[f:])
-			
-		except IOError as e:
-			common.onError(str(e))
 
 
+#------ Compression ------
+
+def compress_file(path, data = None):
+	"""Write the gzip-compressed version of the file at the given path,
+	with ".gz" appended to the path. If data is None, the content is
+	read from the file."""
+	if data is None:
+		with open(path, "rb") as input:
+			data = input.read()
+	with open(path + ".gz", "wb") as out:
+		out.write(gzip.compress(data, 9, mtime = 0))
+
+
+class Compressor:
+	"""Precompressed versions of the output files (HTML_PRECOMPRESS),
+	produced in a pool of threads (zlib releases the Python lock while
+	compressing). Worker processes of parallel generation compress
+	their pages directly."""
+
+	def __init__(self, jobs):
+		self.pid = os.getpid()
+		self.pool = concurrent.futures.ThreadPoolExecutor(jobs)
+		self.futures = []
+
+	def compress(self, path, data = None):
+		"""Compress the file at the given path (see compress_file())."""
+		if os.getpid() != self.pid:
+			try:
+				compress_file(path, data)
+			except OSError as e:
+				raise common.BackException(str(e))
+		else:
+			self.futures.append(self.pool.submit(compress_file, path, data))
+
+	def close(self):
+		"""Wait for the end of the compressions."""
+		self.pool.shutdown()
+		for future in self.futures:
+			try:
+				future.result()
+			except OSError as e:
+				raise common.BackException(str(e))
+		self.futures = []
+
+
+def is_compressed(path):
+	"""Test if the compressed version of the file at the given path
+	exists and is up to date."""
+	try:
+		return os.stat(path + ".gz").st_mtime_ns >= os.stat(path).st_mtime_ns
+	except OSError:
+		return False
+
+
+def remove_compressed(path):
+	"""Remove the compressed version of the file at the given path,
+	if any."""
+	try:
+		os.remove(path + ".gz")
+	except FileNotFoundError:
+		pass
+	except OSError as e:
+		raise common.BackException(str(e))
+
+
+def is_copied(path, tpath):
+	"""Test if the file at tpath is an up to date copy (made by
+	copy_friend()) of the file at path."""
+	try:
+		s = os.stat(path)
+		t = os.stat(tpath)
+		return s.st_size == t.st_size and s.st_mtime_ns == t.st_mtime_ns
+	except OSError:
+		return False
+
+
+def copy_friend(path, tpath):
+	"""Copy the file at path to tpath, keeping its date. The copy
+	is performed in a temporary file renamed at the end so that
+	concurrent copies to the same file do not produce a partial file."""
+	os.makedirs(os.path.dirname(tpath), exist_ok = True)
+	temp = "%s.%d.tmp" % (tpath, os.getpid())
+	shutil.copy2(path, temp)
+	os.replace(temp, tpath)
+
 
 #------ Policy classes ------
 
 class Policy(html.Manager, PageHandler):
 	"""Generator for HTML output."""
+	current = None
+	page = 0
 
-	def __init__(self, doc, ui):
+	def __init__(self, doc, ui, run = True):
 		self.doc = doc
 		self.db = doc.get_base()
 		self.ui = ui
@@ -274,7 +631,25 @@ class Policy(html.Manager, PageHandler):
 		self.id = os.path.basename(os.path.splitext(doc.get_name())[0])
 		self.import_path = None
 		self.template = self.get_template()
+		self.friends = []
+		self.friend_paths = {}
+		self.styles = None
+		self.compressor = None
+		if run:
+			self.generate()
+
+	def generate(self):
+		"""Generate the output files."""
+		self.manifest = manifest.Manifest(self.make_manifest_path())
+		if self.get_precompress():
+			self.compressor = Compressor(self.get_jobs())
 		self.run()
+		for path in self.manifest.prune():
+			remove_compressed(path)
+		self.manifest.save()
+		if self.compressor is not None:
+			self.compress_friends()
+			self.compressor.close()
 
 	def get_doc(self):
 		"""Get the current document."""
@@ -301,19 +676,56 @@ class Policy(html.Manager, PageHandler):
 				os.path.relpath(self.doc.get_name(), self.root_dir))
 		return path + suff + ".html"
 
-	def open_out(self, path = None):
-		"""Open an output file."""
+	def get_precompress(self):
+		"""Test if precompressed versions of the output files are
+		required (variable HTML_PRECOMPRESS)."""
+		value = self.doc["HTML_PRECOMPRESS"]
+		return value is not None and str(value).lower() in ("yes", "true", "on", "1")
+
+	def compress_friends(self):
+		"""Compress the friend files that changed. A friend may be
+		recorded several times when several workers of gen_pages()
+		added it."""
+		for path in dict.fromkeys(self.friends):
+			if os.path.isfile(path) and not is_compressed(path):
+				self.compressor.compress(path)
+
+	def make_manifest_path(self):
+		"""Build the path of the manifest of the generated pages."""
+		return os.path.splitext(self.make_out_path())[0] + ".manifest"
+
+	def open_out(self, path = None, out = None, fragments = html.SINK_FRAGMENTS):
+		"""Open an output file. If no binary stream out is given, the
+		page is generated in memory and written by close_out()."""
 		if not path:
 			path = self.make_out_path()
 		self.out_path = path
-		try:
-			self.out = open(self.out_path, "w")
-		except OSError as e:
-			raise common.BackException(e)
+		self.footnotes = []
+		self.select_links(path)
+		encoding = self.get_encoding()
+		if not encoding:
+			encoding = "UTF-8"
+		if out is None:
+			self.buffer = io.BytesIO()
+			out = self.buffer
+		self.out = html.Sink(out, str(encoding), fragments)
 
 	def close_out(self):
-		"""Close the current output path."""
-		self.out.close()
+		"""Close the current output path. The page is only written if
+		its content changed since the previous generation (see
+		thot.manifest). Return the manifest entry of the page. Without
+		precompression, a compressed version left by a previous
+		generation is removed when the page is written."""
+		self.out.finish()
+		data = self.buffer.getvalue()
+		entry = self.manifest.write(self.out_path, data)
+		if self.compressor is not None:
+			if entry.written or not is_compressed(self.out_path):
+				self.compressor.compress(self.out_path, data)
+		elif entry.written:
+			remove_compressed(self.out_path)
+		self.buffer = None
+		return entry
 
 	def get_import(self):
 		"""Get or create the import directory."""
@@ -327,38 +739,49 @@ class Policy(html.Manager, PageHandler):
 			try:
 				os.makedirs(self.import_path)
 			except OSError as e:
-				raise BackException(str(e))
+				raise common.BackException(str(e))
 		else:
 			try:
 				for p in glob(os.path.join(self.import_path, "*gen-*.*")):
 					os.remove(p)
 			except OSError as e:
-				raise BackException(str(e))
+				raise common.BackException(str(e))
 		return self.import_path
 			
 	def add_friend(self, path):
-		path = os.abspath(path)
-		if self.in_place and path.is_prefix(self.root_dir):
-			return path
+		"""Resolve a friend file, copying it in the import directory
+		if required. A file is resolved only once per policy and is only
+		copied if its copy is out of date."""
+		path = os.path.abspath(path)
+		try:
+			return self.friend_paths[path]
+		except KeyError:
+			pass
+		if self.in_place and path.startswith(self.root_dir):
+			tpath = path
 		else:
 			ipath = self.get_import()
-			if path.is_prefix(self.root_dir):
+			if path.startswith(self.root_dir):
 				rpath = path[len(self.root_dir)+1:]
 			else:
 				rpath = os.path.basename(path)
+			tpath = os.path.join(ipath, rpath)
 			try:
-				# could be optimized to avoid copy
-				tpath = os.path.join(ipath, rpath)
-				os.makedirs(os.path.dirname(tpath), exist_ok = True)
-				shutil.copyfile(path, tpath)
-				return tpath
+				if not is_copied(path, tpath):
+					copy_friend(path, tpath)
 			except OSError as e:
-				raise BackException(str(e))
+				raise common.BackException(str(e))
+			self.friends.append(tpath)
+		self.friend_paths[path] = tpath
+		return tpath
 
 	def new_friend(self, name = "", suffix = None):
 		ipath = self.get_import()
 		if suffix == None:
 			path = os.path.join(ipath, name)
+			os.makedirs(os.path.dirname(path), exist_ok = True)
+			self.friends.append(path)
+			self.friend_paths[path] = path
 			return path
 		else:
 			if name == None:
@@ -368,12 +791,46 @@ class Policy(html.Manager, PageHandler):
 			n = 0
 			while True:
 				path = os.path.join(ipath, "%s-%d.%s" % (name, n, suffix))
-				if not os.exist(path):
+				if not os.path.exists(path):
+					self.friends.append(path)
+					self.friend_paths[path] = path
 					return path
 				n = n + 1
 
 	def get_number(self, node):
-		return node.get_info("number")
+		return self.numbering.get_number(node)
+
+	def get_friend_ref(self, path):
+		if not os.path.isabs(path):
+			return path
+		return os.path.relpath(path, os.path.dirname(os.path.abspath(self.out_path)))
+
+	def add_footnote(self, note):
+		self.footnotes.append(note)
+		return len(self.footnotes)
+
+	def gen_footnotes(self):
+		if self.footnotes:
+			html.gen_items(self, html.gen_footnotes(self, self.footnotes))
+
+	def get_styles(self):
+		"""Get the paths of the style sheets of HTML_STYLES, resolved
+		once per policy."""
+		if self.styles is None:
+			self.styles = []
+			styles = self.doc["HTML_STYLES"]
+			if styles:
+				for style in str(styles).split(':'):
+					self.styles.append(self.add_friend(style))
+		return self.styles
+
+	def gen_head(self):
+		for style in self.get_styles():
+			ref = self.get_friend_ref(style)
+			self.write('	<link rel="stylesheet" type="text/css" href="' + html.escape_attr(ref) + '">\n')
+
+	def translate(self, text):
+		return self.db.get_translator(self.doc).get(text)
 
 	def get_title(self):
 		return self.doc['TITLE']
@@ -384,261 +841,367 @@ class Policy(html.Manager, PageHandler):
 	def write(self, text):
 		self.out.write(text)
 
+	def get_writer(self):
+		return self.out.write
+
 	def get_toc_label(self):
 		return self.db.get_translator(self.doc).get(i18n.ID_CONTENT)
 
-	def make_ref(self, nums):
-		"""Generate a reference from an header number array."""
-		return ".".join([str(i) for i in nums])
+	def make_pager(self):
+		"""Build the pager dispatching the nodes in pages."""
+		return numbering.Pager(self.make_out_path())
+
+	def get_jobs(self):
+		"""Get the number of processes generating the pages
+		(variable THOT_JOBS)."""
+		jobs = self.doc["THOT_JOBS"]
+		if not jobs:
+			return 1
+		try:
+			return max(1, int(jobs))
+		except ValueError:
+			raise common.BackException("bad THOT_JOBS value: %s" % jobs)
+
+	def gen_page(self, view):
+		"""Generate the page of the given view. Return the manifest
+		entry of the page."""
+		self.open_out(view.path)
+		self.current = view
+		self.page = view.index
+		view.node.getContent()		# build a delayed body before the TOC
+		self.template.apply(self)
+		return self.close_out()
+
+	def gen_pages(self):
+		"""Generate the pages of the numbering. If several jobs are
+		required, the pages are dispatched in batches to a pool of
+		forked processes, inheriting the document tree. Whatever the
+		number of jobs, the pages are reported in document order."""
+		global WORKER
+		views = pages.get_views(self.numbering)
+		jobs = min(self.get_jobs(), len(views))
+		if jobs <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+			for view in views:
+				self.ui.print_command("generating %s" % view.path)
+				self.gen_page(view)
+				self.ui.print_success()
+		else:
+			WORKER = self
+			size = max(1, len(views) // (jobs * 4))
+			try:
+				with multiprocessing.get_context("fork").Pool(jobs) as pool:
+					results = pool.imap(gen_page, range(len(views)), size)
+					for (view, (entry, friends, error)) in zip(views, results):
+						self.ui.print_command("generating %s" % view.path)
+						if error is not None:
+							raise common.BackException(error)
+						self.manifest.add(entry)
+						self.friends.extend(friends)
+						self.ui.print_success()
+			finally:
+				WORKER = None
+
+	def prepare(self):
+		"""Compute the references and prepare the document for the
+		generation."""
+		self.gen_refs()
+		self.doc.pregen(self)
+		self.get_styles()
+
+	def select_page(self, index):
+		"""Select the page of the given index as the current page.
+		Return its path."""
+		views = pages.get_views(self.numbering)
+		if not 0 <= index < len(views):
+			raise common.BackException("no page %d" % index)
+		view = views[index]
+		self.current = view
+		self.page = index
+		view.node.getContent()		# build a delayed body before the TOC
+		return view.path
+
+	def stream_page(self, index, out, fragments = html.SINK_FRAGMENTS):
+		"""Generate the page of the given index to the binary stream out,
+		without manifest. The policy must be prepared (see prepare())."""
+		self.open_out(self.select_page(index), out, fragments)
+		self.template.apply(self)
+		self.out.finish()
+
+	def gen_refs(self):
+		"""Compute the numbers and the references of the document."""
+		self.numbering = numbering.get_numbering(self.doc, self.make_pager())
+		self.link_tables = { }
+
+	def select_links(self, path):
+		"""Select the tables of links for a page at the given path.
+		The tables are shared by the pages of the same directory:
+		* links -- relative paths of the pages, indexed by page,
+		* refs -- references of the nodes out of the current page,
+		  filled on demand and indexed by node identifier."""
+		dir = os.path.dirname(path)
+		try:
+			self.links, self.refs = self.link_tables[dir]
+		except KeyError:
+			start = dir if dir else os.curdir
+			self.links = [os.path.relpath(self.numbering.get_page_path(i), start)
+				for i in range(self.numbering.get_page_count())]
+			self.refs = { }
+			self.link_tables[dir] = (self.links, self.refs)
+
+	def get_ref(self, node):
+		page = self.numbering.get_page(node)
+		if page is None:
+			return None
+		elif page == self.page:
+			return '#' + self.numbering.get_anchor(node)
+		try:
+			return self.refs[node.node_id]
+		except KeyError:
+			ref = self.links[page] + '#' + self.numbering.get_anchor(node)
+			self.refs[node.node_id] = ref
+			return ref
+
+	def get_remote_ref(self, node):
+		page = self.numbering.get_page(node)
+		if page is None:
+			return None
+		path = os.path.basename(self.numbering.get_page_path(page))
+		return path + '#' + self.numbering.get_anchor(node)
+
+	def get_node_page(self, node):
+		"""Get the page containing any node: the page of its closest
+		numbered ancestor or the main page."""
+		while node is not None:
+			page = self.numbering.get_page(node)
+			if page is not None:
+				return page
+			node = node.parent
+		return 0
+
+	def get_anchor_ref(self, node, anchor):
+		page = self.get_node_page(node)
+		if page == self.page:
+			return '#' + anchor
+		return self.links[page] + '#' + anchor
+
+	def get_remote_anchor_ref(self, node, anchor):
+		page = self.get_node_page(node)
+		return os.path.basename(self.numbering.get_page_path(page)) + '#' + anchor
+
+	def is_local(self, node):
+		return self.numbering.get_page(node) == self.page
 
 
 class AllInOne(Policy):
 	"""Simple page policy doing nothing: only one page."""
+	current = None
 
-	def __init__(self, doc, ui):
-		Policy.__init__(self, doc, ui)
-
-	def gen_refs(self, path):
-		"""Generate and return the references for the given generator."""
-		self.make_refs([1], { }, self.doc, path)
+	def __init__(self, doc, ui, run = True):
+		Policy.__init__(self, doc, ui, run)
 
-	def make_refs(self, nums, others, node, path):
-		"""Traverse the document tree and generate references in the given map."""
-		
-		# number for header
-		num = node.numbering()
-		if num == 'header':
-			r = self.make_ref(nums)
-			node.set_info("number", r)
-			node.set_info("ref", path + "#" + r)
-			nums.append(1)
-			for item in node.getContent():
-				self.make_refs(nums, others, item, path)
-			nums.pop()
-			nums[-1] = nums[-1] + 1
-		
-		# number for embedded
-		else:
-			if self.doc.get_label_for(node):
-				if num:
-					if num not in others:
-						others[num] = 1
-						n = 1
-					else:
-						n = others[num] + 1
-					r = "%s-%d" % (num, n)
-					node.set_info("number", r)
-					node.set_info("ref", path + "#" + r)
-					others[num] = n
-			for item in node.getContent():
-				self.make_refs(nums, others, item, path)
-	
 	def gen_toc(self):
 		if self.current == None:
 			self.template.gen_toc(self, [], 0)
 		else:
-			self.templaten.gen_toc(self, [self.current], 100)
+			self.template.gen_toc(self, [self.current], 100)
 		
 	def gen_content(self):
 		for node in self.doc.getContent():
 			html.gen(self, node)
 
+	def select_page(self, index):
+		if index != 0:
+			raise common.BackException("no page %d" % index)
+		return self.make_out_path()
+
 	def run(self):
+		self.prepare()
 		self.open_out()
-		self.gen_refs(self.out_path)
-		self.doc.pregen(self.db)
 		self.template.apply(self)
 		self.close_out()
 
-	def get_ref(self, node):
-		ref = node.get_info("ref")
-		if not ref:
+
+class ChapterPager(numbering.Pager):
+	"""Pager creating a page for each chapter."""
+
+	def __init__(self, policy):
+		numbering.Pager.__init__(self, policy.make_out_path())
+		self.policy = policy
+
+	def get_page_level(self):
+		return 0
+
+	def get_page(self, entry, nums, index):
+		if entry.level == 0 and entry.parent is None:
+			return self.policy.make_out_path("-%d" % (nums[0] - 1))
+		else:
 			return None
-		path, anchor = ref.split('#')
-		cpath = os.path.commonpath([path, self.out_path])
-		return path[len(cpath):] + '#' + anchor
 
 
 class PerChapter(Policy):
 	"""This page policy ensures there is one page per chapter."""
-	node = None
+	current = None
 	
-	def __init__(self, doc, ui):
-		Policy.__init__(self, doc, ui)
+	def __init__(self, doc, ui, run = True):
+		Policy.__init__(self, doc, ui, run)
 
-	def gen_refs(self):
-		"""Generate and return the references for the given generator."""
-		self.make_refs([1], { }, self.doc, self.make_out_path())
-
-	def make_refs(self, nums, others, node, path):
-		"""Traverse the document tree and generate references in the given map."""
-		
-		# number for header
-		num = node.numbering()
-		if num == 'header':
-			if node.header_level == 0:
-				path = self.make_out_path("-%d" % (nums[0] - 1))
-			r = self.make_ref(nums)
-			node.set_info("number", r)
-			node.set_info("ref", path + "#" + r)
-			nums.append(1)
-			for item in node.getContent():
-				self.make_refs(nums, others, item, path)
-			nums.pop()
-			nums[-1] = nums[-1] + 1
-		
-		# number for embedded
-		else:
-			if self.doc.get_label_for(node):
-				if num:
-					if num not in others:
-						others[num] = 1
-						n = 1
-					else:
-						n = others[num] + 1
-					r = "%s-%d" % (num, n)
-					node.set_info("number", r)
-					node.set_info("ref", path + "#" + r)
-					others[num] = n
-			for item in node.getContent():
-				self.make_refs(nums, others, item, path)
+	def make_pager(self):
+		return ChapterPager(self)
 
 	def gen_toc(self):
-		self.template.gen_toc(self, [self.current], 100)
+		self.template.gen_toc(self, [self.current.node], 100)
 		
 	def gen_content(self):
-		if self.current == None:
-			for node in self.doc.getContent():
-				if node.getHeaderLevel() == 0:
-					break
-				html.gen(self, node)
+		if self.current.parent is None:
+			html.gen_items(self, self.current.get_body())
 		else:
-			html.gen(self, self.current)
-
-	def get_ref(self, node):
-		ref = node.get_info("ref")
-		if not ref:
-			return None
-		path, anchor = ref.split('#')
-		cpath = os.path.commonpath([path, self.out_path])
-		return path[len(cpath):] + '#' + anchor
+			html.gen(self, self.current.node)
 
 	def run(self):
-		chapters = []
+		self.prepare()
+		self.gen_pages()
 
-		# generate main page
-		path = self.make_out_path()
-		self.ui.print_command("generating %s" % path)
-		self.open_out(path)
-		self.gen_refs()
-		self.doc.pregen(self.db)
-		self.current = None
-		for node in self.doc.getContent():
-			if node.getHeaderLevel() == 0:
-				chapters.append(node)
-		self.template.apply(self)
-		self.close_out()
-		self.ui.print_success()
 
-		# generate chapter pages
-		for i in range(0, len(chapters)):
-			path = self.make_out_path("-%d" % i)
-			self.ui.print_command("generating %s" % path)
-			self.open_out(path)
-			self.current = chapters[i]
-			self.template.apply(self)
-			self.close_out()
-			self.ui.print_success()
+class SectionPager(numbering.Pager):
+	"""Pager creating a page for each header."""
+
+	def __init__(self, policy):
+		numbering.Pager.__init__(self, policy.make_out_path())
+		self.policy = policy
+
+	def get_page(self, entry, nums, index):
+		return self.policy.make_out_path("-%d" % (index - 1))
 
 
 class PerSection(Policy):
 	"""This page policy ensures there is one page per section."""
-	node = None
+	current = None
 	
-	def __init__(self, doc, ui):
-		Policy.__init__(self, doc, ui)
+	def __init__(self, doc, ui, run = True):
+		Policy.__init__(self, doc, ui, run)
 
-	def gen_refs(self):
-		"""Generate and return the references for the given generator."""
-		self.pages = [(self.make_out_path(), self.doc, [])]
-		self.make_refs([1], { }, self.doc, 0, [])
-
-	def make_refs(self, nums, others, node, pagenum, toc):
-		"""Traverse the document tree and generate references in the given map."""
-		
-		# number for header
-		if node.numbering() == 'header':
-			path = self.make_out_path("-%d" % pagenum)
-			toc = toc + [node]
-			pagenum = pagenum + 1
-			r = self.make_ref(nums)
-			node.set_info("number", r)
-			node.set_info("ref", path + "#" + r)
-			nums.append(1)
-			self.pages.append((path, node, toc))
-			for item in node.getContent():
-				pagenum = self.make_refs(nums, others, item, pagenum, toc)
-			nums.pop()
-			nums[-1] = nums[-1] + 1
-		
-		# number for embedded
-		else:
-			if self.doc.get_label_for(node):
-				if num:
-					if num not in others:
-						others[num] = 1
-						n = 1
-					else:
-						n = others[num] + 1
-					r = "%s-%d" % (num, n)
-					node.set_info("number", r)
-					node.set_info("ref", path + "#" + r)
-					others[num] = n
-			for item in node.getContent():
-				pagenum = self.make_refs(nums, others, item, pagenum, toc)
-
-		return pagenum
+	def make_pager(self):
+		return SectionPager(self)
 
 	def gen_toc(self):
-		self.template.gen_toc(self, self.current[1], 1)
+		self.template.gen_toc(self, self.current.headers, 1)
 		
 	def gen_content(self):
-		for node in self.current[0].getContent():
-			if node.getHeaderLevel() < 0:
-				html.gen(self, node)
-
-	def get_ref(self, node):
-		ref = node.get_info("ref")
-		if not ref:
-			return None
-		path, anchor = ref.split('#')
-		cpath = os.path.commonpath([path, self.out_path])
-		return path[len(cpath):] + '#' + anchor
+		html.gen_items(self, self.current.get_body())
 
 	def run(self):
-		self.gen_refs()
-		self.doc.pregen(self.db)
-		for (path, node, toc) in self.pages:
-			self.ui.print_command("generating %s" % path)
-			self.open_out(path)
-			self.current = (node, toc)
-			self.template.apply(self)
-			self.close_out()
-			self.ui.print_success()
+		self.prepare()
+		self.gen_pages()
+
+
+#------ parallel generation ------
+
+WORKER = None
+
+def gen_page(index):
+	"""Generate a page in a worker process of Policy.gen_pages().
+	Return the manifest entry of the page, the friend files added by
+	the page and the error message (the entry or the error is None)."""
+	view = pages.get_views(WORKER.numbering)[index]
+	start = len(WORKER.friends)
+	try:
+		entry = WORKER.gen_page(view)
+		return (entry, WORKER.friends[start:], None)
+	except common.ThotException as e:
+		return (None, [], str(e))
+
+
+#------ streaming ------
+
+STREAM_FRAGMENTS = 256
+STREAM_QUEUE = 16
+
+class StreamCancelled(Exception):
+	"""Raised in the generation of a stream when the consumer stopped."""
+	pass
+
+
+class StreamQueue:
+	"""Binary stream passing the written blocks through a bounded
+	queue to the consumer of a stream. The generation waits when
+	the queue is full and stops if the consumer is cancelled."""
+
+	def __init__(self, size = STREAM_QUEUE):
+		self.queue = queue.Queue(size)
+		self.cancelled = False
+
+	def put(self, item):
+		while True:
+			if self.cancelled:
+				raise StreamCancelled()
+			try:
+				self.queue.put(item, timeout = 0.1)
+				return
+			except queue.Full:
+				pass
+
+	def write(self, data):
+		self.put(data)
+
+	def close(self):
+		pass
+
+
+def stream(doc, ui, page = 0, fragments = STREAM_FRAGMENTS):
+	"""Generate the page of the given index (the main page by default)
+	of the document and return an iterator on the HTML text as encoded
+	chunks (bytes). The page is generated in a separate thread while
+	the chunks are consumed: the first chunks are available before the
+	end of the generation. No file is written for the pages. Closing
+	the iterator stops the generation."""
+	policy = get_policy(doc)(doc, ui, False)
+	policy.prepare()
+	out = StreamQueue()
+	errors = []
+
+	def produce():
+		try:
+			policy.stream_page(page, out, fragments)
+		except StreamCancelled:
+			return
+		except Exception as e:
+			errors.append(e)
+		try:
+			out.put(None)
+		except StreamCancelled:
+			pass
+
+	thread = threading.Thread(target = produce, daemon = True)
+	thread.start()
+	try:
+		while True:
+			chunk = out.queue.get()
+			if chunk is None:
+				break
+			yield chunk
+	finally:
+		out.cancelled = True
+		thread.join()
+	if errors:
+		raise errors[0]
 
 
 #------ plug-in interface ------
 
-def output(doc, ui):
+def get_policy(doc):
+	"""Get the policy class selected by HTML_ONE_FILE_PER."""
 	org = doc['HTML_ONE_FILE_PER']
 	if org == 'document' or not org:
-		AllInOne(doc, ui)
+		return AllInOne
 	elif org == 'chapter':
-		PerChapter(doc, ui)
+		return PerChapter
 	elif org == 'section':
-		PerSection(doc, ui)
+		return PerSection
 	else:
-		raise BackException('one_file_per %s structure is not supported' % self.struct)
+		raise common.BackException('one_file_per %s structure is not supported' % org)
+
+def output(doc, ui):
+	get_policy(doc)(doc, ui)
 
 
 __short__ = "back-end for HTML output"
@@ -650,8 +1213,10 @@ the processed document DOC.thot.
 Following variables are supported:
 """ + common.make_var_doc([
 	("HTML_ONE_FILE_PER",	"generated files: one of document (default), chapter, section"),
+	("HTML_PRECOMPRESS",	"if yes, also write gzip-compressed versions (.gz) of the generated files"),
 	("HTML_SHORT_ICON",		"short icon path for HTML file"),
 	("HTML_STYLES",			"CSS styles to use (':' separated)"),
-	("HTML_TEMPLATE",		"template used to generate pages")
+	("HTML_TEMPLATE",		"template used to generate pages"),
+	("THOT_JOBS",			"number of processes generating the pages (option -j)")
 ])
 
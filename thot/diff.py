@@ -0,0 +1,270 @@
+#
+# Thot2 -- document generator
+# Copyright (C) 2009  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Structural comparison of two versions of a document.
+
+The comparison works on the trees of the documents. A hash is
+first computed for each sub-tree, bottom-up, so that identical
+sub-trees are recognized at once. Then the children of the compared
+containers are matched: headers by their label or, if they have no
+label, by their title; other nodes by their hash, the remaining
+nodes being paired in order by class. Matched nodes that are not
+in the same order are reported as moved (the kept order is the
+longest increasing subsequence of the matched positions) and paired
+nodes that differ are compared recursively.
+
+A sub-tree deleted at one place and inserted at another place
+is reported as moved."""
+
+import bisect
+from collections import deque
+
+import thot.doc as doc
+
+INSERTED = "inserted"
+DELETED = "deleted"
+MOVED = "moved"
+MODIFIED = "modified"
+
+SKIP = { "parent", "node_id", "header_entry", "lazy_body", "doc",
+	"do_title" }
+
+
+class Change:
+	"""A change between two documents.
+	* kind -- one of INSERTED, DELETED, MOVED or MODIFIED,
+	* old -- node in the old document (None for INSERTED),
+	* new -- node in the new document (None for DELETED),
+	* header -- header of the new document (or the new document itself)
+	  containing the change."""
+
+	def __init__(self, kind, old, new, header):
+		self.kind = kind
+		self.old = old
+		self.new = new
+		self.header = header
+
+	def __str__(self):
+		node = self.new if self.new is not None else self.old
+		return "%s %s" % (self.kind, node.__class__.__name__)
+
+
+def value_key(value):
+	"""Build a hashable key for an attribute value of a node."""
+	if value is None or isinstance(value, (str, int, float, bool)):
+		return value
+	elif isinstance(value, doc.Node):
+		return (value.__class__.__name__, value.toText())
+	elif isinstance(value, (list, tuple)):
+		return tuple(value_key(v) for v in value)
+	elif isinstance(value, dict):
+		return tuple(sorted((str(k), value_key(v)) for (k, v) in value.items()))
+	else:
+		return value.__class__.__name__
+
+
+def local_key(node):
+	"""Build the key of a node without its children."""
+	if isinstance(node, doc.Document):
+		return "document"
+	key = [node.__class__.__name__]
+	container = isinstance(node, doc.Container)
+	for name in sorted(node.__dict__):
+		if name in SKIP or (container and name == "content"):
+			continue
+		key.append((name, value_key(node.__dict__[name])))
+	return tuple(key)
+
+
+def children(node):
+	"""Get the child nodes of a node."""
+	if isinstance(node, doc.Container):
+		return node.getContent()
+	else:
+		return []
+
+
+class Hasher(doc.Visitor):
+	"""Visitor computing the hashes of the sub-trees and storing them
+	in hashes, indexed by the node Python identity."""
+
+	def __init__(self, hashes):
+		self.hashes = hashes
+
+	def endNode(self, node):
+		self.hashes[id(node)] = hash((local_key(node),
+			tuple(self.hashes[id(child)] for child in children(node))))
+
+
+def hash_tree(root, hashes):
+	"""Compute the hashes of the sub-trees of root."""
+	Hasher(hashes).walk(root)
+
+
+def longest_increasing(seq):
+	"""Get the set of positions in seq of a longest increasing
+	subsequence."""
+	tails = []
+	tail_pos = []
+	prev = [-1] * len(seq)
+	for (i, v) in enumerate(seq):
+		k = bisect.bisect_left(tails, v)
+		if k == len(tails):
+			tails.append(v)
+			tail_pos.append(i)
+		else:
+			tails[k] = v
+			tail_pos[k] = i
+		prev[i] = tail_pos[k - 1] if k > 0 else -1
+	res = set()
+	i = tail_pos[-1] if tail_pos else -1
+	while i >= 0:
+		res.add(i)
+		i = prev[i]
+	return res
+
+
+class Diff:
+	"""Differences between an old and a new version of a document."""
+
+	def __init__(self, old, new):
+		self.old = old
+		self.new = new
+		self.changes = []
+		self.hashes = { }
+		hash_tree(old, self.hashes)
+		hash_tree(new, self.hashes)
+		self.compare()
+		self.find_moves()
+
+	def get_hash(self, node):
+		return self.hashes[id(node)]
+
+	def match_key(self, node, document):
+		"""Get the key used to match children."""
+		if isinstance(node, doc.Header):
+			label = document.get_label_for(node)
+			if label is not None:
+				return ("label", label)
+			else:
+				return ("title", node.getTitle().toText())
+		else:
+			return ("hash", self.get_hash(node))
+
+	def compare(self):
+		"""Compare the document trees."""
+		stack = [(self.old, self.new, self.new)]
+		while stack:
+			old, new, header = stack.pop()
+			if isinstance(new, doc.Header):
+				header = new
+			if local_key(old) != local_key(new):
+				self.changes.append(Change(MODIFIED, old, new, header))
+			ochildren = children(old)
+			nchildren = children(new)
+
+			# match by key
+			keys = { }
+			for (i, child) in enumerate(ochildren):
+				keys.setdefault(self.match_key(child, self.old), deque()).append(i)
+			omatch = [None] * len(ochildren)
+			nmatch = [None] * len(nchildren)
+			for (i, child) in enumerate(nchildren):
+				olds = keys.get(self.match_key(child, self.new))
+				if olds:
+					j = olds.popleft()
+					omatch[j] = i
+					nmatch[i] = j
+
+			# pair the remaining nodes by class
+			classes = { }
+			for (j, child) in enumerate(ochildren):
+				if omatch[j] is None and not isinstance(child, doc.Header):
+					classes.setdefault(child.__class__, deque()).append(j)
+			for (i, child) in enumerate(nchildren):
+				if nmatch[i] is None:
+					olds = classes.get(child.__class__)
+					if olds:
+						j = olds.popleft()
+						omatch[j] = i
+						nmatch[i] = j
+
+			# record insertions, deletions and moves
+			for (j, child) in enumerate(ochildren):
+				if omatch[j] is None:
+					self.changes.append(Change(DELETED, child, None, header))
+			pairs = [(i, j) for (i, j) in enumerate(nmatch) if j is not None]
+			kept = longest_increasing([j for (_, j) in pairs])
+			for (k, (i, j)) in enumerate(pairs):
+				if k not in kept:
+					self.changes.append(Change(MOVED, ochildren[j], nchildren[i], header))
+			for (i, child) in enumerate(nchildren):
+				j = nmatch[i]
+				if j is None:
+					self.changes.append(Change(INSERTED, None, child, header))
+				elif self.get_hash(ochildren[j]) != self.get_hash(child):
+					stack.append((ochildren[j], child, header))
+
+	def find_moves(self):
+		"""Replace a deletion and an insertion of the same sub-tree
+		by a move."""
+		deleted = { }
+		for (i, change) in enumerate(self.changes):
+			if change.kind == DELETED:
+				deleted.setdefault(self.get_hash(change.old), deque()).append(i)
+		removed = set()
+		for change in self.changes:
+			if change.kind == INSERTED:
+				dels = deleted.get(self.get_hash(change.new))
+				if dels:
+					i = dels.popleft()
+					removed.add(i)
+					change.kind = MOVED
+					change.old = self.changes[i].old
+		if removed:
+			self.changes = [c for (i, c) in enumerate(self.changes) if i not in removed]
+
+	def get_changes(self):
+		"""Get the list of changes."""
+		return self.changes
+
+	def is_empty(self):
+		"""Test if both documents are the same."""
+		return not self.changes
+
+	def get_changed_headers(self):
+		"""Get the headers of the new document (or the new document
+		itself) directly containing a change, in document order."""
+		found = { }
+		for change in self.changes:
+			found[id(change.header)] = change.header
+		headers = [entry.node for entry in self.new.get_headers()
+			if id(entry.node) in found]
+		if id(self.new) in found:
+			headers.insert(0, self.new)
+		return headers
+
+	def dump(self):
+		"""Print the changes (for debugging purpose)."""
+		for change in self.changes:
+			print(change)
+
+
+def diff(old, new):
+	"""Compare two versions of a document and return the Diff object."""
+	return Diff(old, new)
@@ -15,7 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
+import os.path
 import re
+import sys
 
 import thot.common as common
 
@@ -93,6 +96,7 @@ STYLE_BIGGER = "bigger"
 STYLE_SMALLER = "smaller"
 STYLE_CITE = "cite"
 STYLE_CODE = "code"
+STYLE_DELETED = "deleted"
 STYLE_FOOTNOTE = "footnote"
 
 # standard footnote
@@ -257,9 +261,9 @@ class Info:
 			self.info[id] = [ val ]
 			
 	def get_info(self, id, dflt = None):
-		"""Get an information value. None if it not defined."""
+		"""Get an information value. dflt if it not defined."""
 		if not self.info:
-			return None
+			return dflt
 		try:
 			return self.info[id]
 		except KeyError:
@@ -269,34 +273,89 @@ class Info:
 		"""Merge the given information with the current one."""
 		if info.info:
 			for k in info.info.keys():
-				self.setInfo(k, info.info[k])
+				self.set_info(k, info.info[k])
 
 
 # nodes
 class Node(Info):
 	"""Base definition of document nodes."""
-	file = None
-	line = None
+	parent = None
+	node_id = None
 	
 	def __init__(self):
 		pass
 
-	def setFileLine(self, file, line):
-		if self.file == None:
-			self.file = file
-			self.line = line
+	def get_id(self):
+		"""Get the identifier of the node in its document. Identifiers
+		are small integers allocated by the parser manager; None is
+		returned if the node is not registered."""
+		return self.node_id
+
+	def get_parent(self):
+		"""Get the parent node. Return None for the document itself
+		or for a detached node."""
+		return self.parent
+
+	def get_ancestors(self):
+		"""Generate the ancestors of the node, from the parent up to the
+		document."""
+		node = self.parent
+		while node is not None:
+			yield node
+			node = node.parent
+
+	def get_path(self):
+		"""Get the list of nodes from the top of the document (excluded)
+		to the current node (included). For a header, this is the list
+		of enclosing headers."""
+		if self.parent is None:
+			return []
+		path = [self]
+		node = self.parent
+		while node.parent is not None:
+			path.append(node)
+			node = node.parent
+		path.reverse()
+		return path
+
+	def get_document(self):
+		"""Get the document containing the node. Return None for
+		a detached node."""
+		node = self
+		while node.parent is not None:
+			node = node.parent
+		if isinstance(node, Document):
+			return node
+		else:
+			return None
+
+	def get_position(self):
+		"""Get the source position of the node as a pair (file, line).
+		Return (None, 0) if the position is unknown."""
+		document = self.get_document()
+		if document is None:
+			return (None, 0)
+		return document.get_position(self)
+
+	def get_location(self):
+		"""Get the source position of the node as a "file:line" string."""
+		file, line = self.get_position()
+		if file is None:
+			return "<unknown>"
+		return "%s:%d" % (file, line)
 
 	def onError(self, msg):
-		"""Called to display an error."""
-		common.onError('%s:%d: %s' % (self.file, self.line, msg))
+		"""Called to report an error: raise a ThotException
+		prefixed by the location of the node."""
+		raise common.ThotException('%s: %s' % (self.get_location(), msg))
 
 	def onWarning(self, msg):
 		"""Called to display a warning."""
-		common.onWarning('%s:%d: %s' % (self.file, self.line, msg))
+		sys.stderr.write('WARNING: %s: %s\n' % (self.get_location(), msg))
 
 	def onInfo(self, msg):
 		"""Called to display an information to the user."""
-		common.onInfo('%s:%d: %s' % (self.file, self.line, msg))
+		sys.stderr.write('%s: %s\n' % (self.get_location(), msg))
 
 	def onEvent(self, man, event):
 		"""Called each time a new word is found.
@@ -369,6 +428,7 @@ class Node(Info):
 
 	def set_caption(self, caption):
 		"""Set the caption of the node."""
+		caption.parent = self
 		self.set_info(INFO_CAPTION, caption)
 
 	def accepts_caption(self):
@@ -386,47 +446,62 @@ class Container(Node):
 
 	def add(self, man, item):
 		if item:
+			item.parent = self
 			self.content.append(item)
 			man.push(item)
 
 	def remove(self, item):
 		"""Remove an item from the container."""
 		self.content.remove(item)
+		item.parent = None
 
 	def append(self, item):
 		"""Add child without refering to the parsing."""
+		item.parent = self
 		self.content.append(item)
 
 	def last(self):
 		return self.content[-1]
 
 	def isEmpty(self):
-		return self.content == []
+		return not self.content
 
 	def clean(self):
-		toremove = []
-		for item in self.content:
-			item.clean()
-			if item.isEmpty():
-				toremove.append(item)
-		for item in toremove:
-			self.content.remove(item)
+		Cleaner().walk(self)
 
 	def dumpHead(self, tab):
 		pass
 
 	def dump(self, tab):
-		self.dumpHead(tab)
-		for item in self.content:
-			item.dump(tab + "  ")
-		print(tab + ")")
+		stack = [(self, tab, False)]
+		while stack:
+			node, tab, done = stack.pop()
+			if done:
+				print(tab + ")")
+			elif isinstance(node, Container) and node.__class__.dump is Container.dump:
+				node.dumpHead(tab)
+				stack.append((node, tab, True))
+				ctab = tab + "  "
+				stack.extend((item, ctab, False) for item in reversed(node.content))
+			else:
+				node.dump(tab)
 
 	def getContent(self):
 		return self.content
 
 	def gen(self, gen):
-		for item in self.content:
-			item.gen(gen)
+		"""Generate the content. Nested containers that do not redefine
+		gen() are expanded without recursion."""
+		stack = [iter(self.content)]
+		while stack:
+			for item in stack[-1]:
+				if item.__class__.gen is Container.gen:
+					stack.append(iter(item.content))
+					break
+				else:
+					item.gen(gen)
+			else:
+				stack.pop()
 
 	def toText(self):
 		r = ""
@@ -477,7 +552,26 @@ class Ref(Node):
 	def visit(self, visitor):
 		visitor.onRef(self)
 
+class TermRef(Node):
+	"""Reference to the definition of a term (#(term) syntax), built
+	by Document.resolve_hash() for a hashed word naming a defined term."""
+	term = None
+
+	def __init__(self, term):
+		Node.__init__(self)
+		self.term = term
+
+	def dump(self, tab):
+		print("%sterm-ref(%s)" % (tab, self.term))
+
+	def gen(self, gen):
+		gen.genText(self.term)
+
+	def __str__(self):
+		return "term-ref(%s)" % self.term
+
 class Tag(Node):
+	doc = None
 	
 	def __init__(self, tag, doc):
 		Node.__init__(self)
@@ -485,7 +579,10 @@ class Tag(Node):
 		self.doc = doc
 	
 	def gen(self, gen):
-		v = self.doc.resolve_hash(self.tag)
+		if self.doc is not None:
+			v = self.doc.resolve_hash(self.tag)
+		else:
+			v = gen.doc.resolve_hash(self.tag)
 		if v != None:
 			v.gen(gen)
 		else:
@@ -803,11 +900,11 @@ class Figure(Block):
 		Node.__init__(self)
 		self.path = path
 		if width:
-			self.setInfo(INFO_WIDTH, width)
+			self.set_info(INFO_WIDTH, width)
 		if height:
-			self.setInfo(INFO_HEIGHT, height)
+			self.set_info(INFO_HEIGHT, height)
 		if align:
-			self.setInfo(INFO_ALIGN, align)
+			self.set_info(INFO_ALIGN, align)
 		if caption:
 			self.set_caption(caption)
 
@@ -837,7 +934,7 @@ class ListItem(Container):
 
 	def __init__(self):
 		Container.__init__(self)
-		self.content.append(Par())
+		self.append(Par())
 
 	def dumpHead(self, tab):
 		print(tab + "item(")
@@ -859,8 +956,8 @@ class List(Container):
 	def onEvent(self, man, event):
 		if event.level is L_WORD:
 			if self.isEmpty():
-				self.content.append(ListItem())
-				self.last().content.append(Par())
+				self.append(ListItem())
+				self.last().append(Par())
 			self.last().last().add(man, event.make())
 		elif event.id is ID_NEW_ITEM:
 			if event.depth < self.depth:
@@ -868,7 +965,7 @@ class List(Container):
 			elif event.depth > self.depth:
 				self.last().add(man, event.make())
 			elif self.kind == event.type:
-				self.content.append(ListItem())
+				self.append(ListItem())
 			else:
 				self.forward(event)
 		elif event.id is ID_END_ITEM:
@@ -899,7 +996,8 @@ class DefItem(Container):
 	def __init__(self):
 		Container.__init__(self)
 		self.term = Par()
-		self.content.append(Par())
+		self.term.parent = self
+		self.append(Par())
 
 	def get_term(self):
 		"""Get the defined term as a container of text-level items."""
@@ -923,7 +1021,7 @@ class DefList(Container):
 	def __init__(self, depth):
 		Container.__init__(self)
 		self.depth = depth
-		self.content.append(DefItem())
+		self.append(DefItem())
 
 	def onEvent(self, man, event):
 		if event.level is L_WORD:
@@ -937,7 +1035,7 @@ class DefList(Container):
 			elif event.depth > self.depth:
 				self.last().add(man, event.make())
 			else:
-				self.content.append(DefItem())
+				self.append(DefItem())
 		elif event.id is ID_END_DEF:
 			man.pop()
 		else:
@@ -975,11 +1073,11 @@ class Cell(Par):
 		Par.__init__(self)
 		self.kind = kind
 		if align:
-			self.setInfo(INFO_ALIGN, align)
+			self.set_info(INFO_ALIGN, align)
 		if span:
-			self.setInfo(INFO_HSPAN, span)
+			self.set_info(INFO_HSPAN, span)
 		if vspan:
-			self.setInfo(INFO_VSPAN, vspan)
+			self.set_info(INFO_VSPAN, vspan)
 
 	def get_align(self):
 		return self.get_info(INFO_ALIGN, TAB_CENTER)
@@ -1106,16 +1204,19 @@ class HorizontalLine(Node):
 
 
 class Header(Container):
+	level = L_HEAD
 	header_level = None
 	title = None
 	do_title = None
+	header_entry = None
+	lazy_body = None
 
 	def __init__(self, level):
 		Container.__init__(self)
-		self.level = L_HEAD
 		self.header_level = level
 		self.do_title = True
 		self.title = Par()
+		self.title.parent = self
 
 	def onEvent(self, man, event):
 		if event.level is L_WORD:
@@ -1156,8 +1257,14 @@ class Header(Container):
 	def get_title(self):
 		return self.title
 
+	def getContent(self):
+		if self.lazy_body is not None:
+			self.lazy_body.materialize()
+		return self.content
+
 	def genBody(self, gen):
-		Container.gen(self, gen)
+		for item in self.getContent():
+			item.gen(gen)
 
 	def gen(self, gen):
 		if gen.genHeader(self):
@@ -1185,6 +1292,7 @@ class Header(Container):
 	
 	def set_title(self, title):
 		"""Set the title of the header."""
+		title.parent = self
 		self.title = title
 
 	def titleText(self):
@@ -1192,6 +1300,27 @@ class Header(Container):
 		return self.title.toText()
 
 
+class HeaderEntry:
+	"""Entry of the header index of a document. Entries are stored
+	in document order so that the descendants of an entry are the
+	entries in the range [index + 1, end).
+	* index -- position of the entry in the header index,
+	* node -- header node,
+	* level -- level of the header,
+	* parent -- entry of the parent header (None for top-level headers),
+	* end -- position following the last descendant of the entry."""
+
+	def __init__(self, index, node, parent):
+		self.index = index
+		self.node = node
+		self.level = node.header_level
+		self.parent = parent
+		self.end = index + 1
+
+	def __str__(self):
+		return "header-entry(%d, %d, %s)" % (self.index, self.level, self.node.titleText())
+
+
 class Feature:
 	"""A feature allows to add special services at generation time.
 	Feature method are called at generation time."""
@@ -1213,6 +1342,7 @@ class HashSource:
 class Document(Container, common.MapEnvironment):
 	"""This is the top object of the document, containing the headings
 	and also the configuration environment."""
+	frozen = False
 
 	def __init__(self, db):
 		Container.__init__(self)
@@ -1223,10 +1353,335 @@ class Document(Container, common.MapEnvironment):
 		self.inv_labels = { }
 		self.uses = []
 		self.files = []
+		self.nodes = []
+		self.types = { }
+		self.source_files = []
+		self.source_ids = { }
+		self.source_file = array('i')
+		self.source_line = array('i')
+		self.register(self)
+		self.headers = []
+		self.numberings = { }
+		self.terms = { }
+		self.lazy_terms = { }
+		self.hash_sources = []
+		self.hash_cache = { }
 
 	def get_name(self):
 		return self["THOT_FILE"]
 
+	def register(self, node, file = None, line = 0):
+		"""Allocate an identifier to the given node and to its ancestors
+		that are not already registered (nodes built without being
+		pushed on the parser stack like list items). The newly registered
+		nodes get the given source position."""
+		if node.node_id is not None:
+			return
+		if file is None:
+			fid = -1
+		else:
+			try:
+				fid = self.source_ids[file]
+			except KeyError:
+				fid = len(self.source_files)
+				self.source_files.append(file)
+				self.source_ids[file] = fid
+		while node is not None and node.node_id is None:
+			node.node_id = len(self.nodes)
+			self.nodes.append(node)
+			self.source_file.append(fid)
+			self.source_line.append(line)
+			self.index_type(node)
+			node = node.parent
+
+	def get_position(self, node):
+		"""Get the source position of a node of the document as a pair
+		(file, line). Return (None, 0) if the position is unknown."""
+		id = node.node_id
+		if id is None or id >= len(self.source_file):
+			return (None, 0)
+		fid = self.source_file[id]
+		if fid < 0:
+			return (None, 0)
+		return (self.source_files[fid], self.source_line[id])
+
+	def get_source_map(self):
+		"""Get the source map of the document, a dictionary associating
+		to each source file the list of pairs (line, node identifier)
+		sorted by line."""
+		map = { }
+		for file in self.source_files:
+			map[file] = []
+		nodes = self.nodes
+		files = self.source_files
+		lines = self.source_line
+		for (id, fid) in enumerate(self.source_file):
+			if fid >= 0 and nodes[id] is not None:
+				map[files[fid]].append((lines[id], id))
+		for entries in map.values():
+			entries.sort()
+		return map
+
+	def index_type(self, node):
+		"""Record the node in the index of node classes."""
+		try:
+			self.types[node.__class__].append(node.node_id)
+		except KeyError:
+			self.types[node.__class__] = [node.node_id]
+
+	def find(self, kind, header = None):
+		"""Get the nodes of the document that are instances of the
+		given class, in parsing order. If a header is given, only the
+		nodes contained in this header are returned."""
+		if header is None:
+			self.materialize()
+		else:
+			header.get_path()[0].getContent()
+		ids = []
+		for (cls, cids) in self.types.items():
+			if issubclass(cls, kind):
+				ids.extend(cids)
+		if len(ids) > 1:
+			ids.sort()
+		res = []
+		for id in ids:
+			node = self.nodes[id]
+			if node is None or (node.parent is None and node is not self):
+				continue
+			if header is not None:
+				parent = node.parent
+				while parent is not None and parent is not header:
+					parent = parent.parent
+				if parent is None:
+					continue
+			res.append(node)
+		return res
+
+	def add_header(self, node):
+		"""Record a header in the header index. The header must already
+		be linked to its parent."""
+		parent = node.parent
+		while parent is not None and not isinstance(parent, Header):
+			parent = parent.parent
+		if parent is None:
+			pentry = None
+			pos = len(self.headers)
+		else:
+			pentry = parent.header_entry
+			pos = pentry.end
+		entry = HeaderEntry(pos, node, pentry)
+		node.header_entry = entry
+		self.numberings = { }
+
+		# insert the entry
+		self.headers.insert(pos, entry)
+		for i in range(pos + 1, len(self.headers)):
+			after = self.headers[i]
+			after.index += 1
+			after.end += 1
+		while pentry is not None:
+			pentry.end += 1
+			pentry = pentry.parent
+
+	def get_headers(self):
+		"""Get the header index, that is, the list of header entries
+		in document order."""
+		return self.headers
+
+	def get_header_children(self, entry = None):
+		"""Generate the entries of the headers directly contained
+		in the header of the given entry. If no entry is given,
+		generate the top-level headers."""
+		headers = self.headers
+		if entry is None:
+			i = 0
+			end = len(headers)
+		else:
+			i = entry.index + 1
+			end = entry.end
+		while i < end:
+			child = headers[i]
+			yield child
+			i = child.end
+
+	def node_by_id(self, id):
+		"""Get the node matching the given identifier. Return None
+		if there is no such node or if it has been removed."""
+		try:
+			return self.nodes[id]
+		except IndexError:
+			return None
+
+	def get_node_count(self):
+		"""Get the number of allocated node identifiers."""
+		return len(self.nodes)
+
+	def restore(self, db, nodes):
+		"""Rebuild the parse-time state of a document loaded from a
+		binary stream (see thot.serial).
+		db -- document base of the document,
+		nodes -- loaded nodes in document order."""
+		self.parent_env = db
+		self.db = db
+		self.nodes = []
+		self.headers = []
+		self.numberings = { }
+		self.inv_labels = { }
+		self.lazy_terms = { }
+		self.hash_cache = { }
+		self.types = { }
+		self.source_ids = { }
+		for (fid, file) in enumerate(self.source_files):
+			self.source_ids[file] = fid
+		for node in nodes:
+			id = node.node_id
+			if id is not None:
+				if id >= len(self.nodes):
+					self.nodes.extend([None] * (id + 1 - len(self.nodes)))
+				self.nodes[id] = node
+				self.index_type(node)
+			if isinstance(node, Header):
+				self.add_header(node)
+		for (label, node) in self.labels.items():
+			self.inv_labels[node] = label
+
+	def clean(self):
+		Container.clean(self)
+		self.forget_removed()
+
+	def forget_removed(self, first = 1):
+		"""Forget the nodes removed from the document whose identifier
+		is greater or equal to first."""
+		nodes = self.nodes
+		for i in range(first, len(nodes)):
+			node = nodes[i]
+			if node is not None and node.parent is None:
+				nodes[i] = None
+
+	def mount(self, document):
+		"""Mount the content of another parsed document at the end of
+		the current document: its top-level headers become chapters of
+		the current document. The content preceding the first header
+		of the mounted document is moved at the start of this header;
+		a mounted document without header is rejected. The nodes are
+		moved, not copied, and get new identifiers; labels, terms,
+		features and the header index are merged. A label of the mounted
+		document already defined in the current document is renamed
+		NAME:LABEL, NAME being the base name of the mounted document,
+		and its references in the mounted document are updated. The
+		mounted document must not be used afterwards."""
+		document.materialize()
+		content = list(document.content)
+		first = 0
+		while first < len(content) and not isinstance(content[first], Header):
+			first += 1
+		if first == len(content) and content:
+			raise common.ThotException("%s: no header to mount the content in"
+				% document.get_name())
+
+		# rename the colliding labels
+		renamed = { }
+		name = os.path.splitext(os.path.basename(str(document.get_name())))[0]
+		for label in document.labels:
+			if label in self.labels:
+				new = "%s:%s" % (name, label)
+				if new in self.labels or new in document.labels:
+					raise common.ThotException("%s: label %s already defined"
+						% (document.get_name(), label))
+				sys.stderr.write("WARNING: %s: label %s already defined, renamed to %s\n"
+					% (document.get_name(), label, new))
+				renamed[label] = new
+
+		# move the nodes
+		fmap = []
+		for file in document.source_files:
+			try:
+				fmap.append(self.source_ids[file])
+			except KeyError:
+				self.source_ids[file] = len(self.source_files)
+				fmap.append(len(self.source_files))
+				self.source_files.append(file)
+		nodes = document.nodes
+		for id in range(1, len(nodes)):
+			node = nodes[id]
+			fid = document.source_file[id]
+			if node is not None:
+				node.node_id = len(self.nodes)
+				self.index_type(node)
+				if isinstance(node, Tag):
+					node.doc = self
+				elif renamed and isinstance(node, Ref) and node.label in renamed:
+					node.label = renamed[node.label]
+			self.nodes.append(node)
+			self.source_file.append(fmap[fid] if fid >= 0 else -1)
+			self.source_line.append(document.source_line[id])
+		if first:
+			header = content[first]
+			for node in content[:first]:
+				node.parent = header
+			header.content = content[:first] + list(header.content)
+		for node in content[first:]:
+			node.parent = self
+			self.content.append(node)
+
+		# merge the header index
+		offset = len(self.headers)
+		for entry in document.headers:
+			entry.index += offset
+			entry.end += offset
+			self.headers.append(entry)
+		self.numberings = { }
+
+		# merge the tables
+		for (label, node) in document.labels.items():
+			self.labels[renamed.get(label, label)] = node
+		for (node, label) in document.inv_labels.items():
+			self.inv_labels[node] = renamed.get(label, label)
+		self.terms.update(document.terms)
+		self.hash_sources.extend(document.hash_sources)
+		self.hash_cache = { }
+		for feature in document.features:
+			self.addFeature(feature)
+		for mod in document.get_uses():
+			if mod not in self.uses:
+				self.use(mod)
+		self.files.extend(document.files)
+
+	def freeze(self):
+		"""Prepare a parsed document to be only read: the delayed header
+		bodies are built, the contents of nodes become tuples and the
+		attributes only used during the parsing are dropped. The document
+		must not be modified after freezing."""
+		if self.frozen:
+			return
+		self.materialize()
+		for node in self.nodes:
+			if node is None:
+				continue
+			attrs = node.__dict__
+			content = attrs.get("content")
+			if content.__class__ is list:
+				node.content = tuple(content)
+			attrs.pop("do_title", None)
+			if isinstance(node, Tag):
+				attrs.pop("doc", None)
+		self.frozen = True
+
+	def materialize(self):
+		"""Build the content of the headers whose parsing has been
+		delayed (see lazy mode of tparser.Manager)."""
+		for node in self.content:
+			if isinstance(node, Header) and node.lazy_body is not None:
+				node.getContent()
+
+	def is_materialized(self):
+		"""Test if the content of all headers is built (see
+		materialize())."""
+		for node in self.content:
+			if isinstance(node, Header) and node.lazy_body is not None:
+				return False
+		return True
+
 	def add_file(self, path):
 		"""Add a file as used to build the document."""
 		self.files.append(path)
@@ -1279,14 +1734,179 @@ class Document(Container, common.MapEnvironment):
 	def get_label(self, label):
 		"""Find the node matching the given label.
 		Return None if there is no node matching the label."""
+		if label not in self.labels:
+			self.materialize()
 		if label in self.labels:
 			return self.labels[label]
 		else:
 			return None
 
+	def add_term(self, term, node):
+		"""Record the definition of a term (#(term) syntax)."""
+		self.terms[term] = node
+		self.hash_cache.pop(term, None)
+
+	def add_lazy_term(self, term, header):
+		"""Record a term defined in the delayed body of the given
+		top-level header (see tparser.LazyScanner)."""
+		self.lazy_terms[term] = header
+		self.hash_cache.pop(term, None)
+
+	def get_term(self, term):
+		"""Get the node defining a term. If the term is defined in
+		a delayed body, this body is built. Return None if the term
+		is not defined."""
+		node = self.terms.get(term)
+		if node is None:
+			header = self.lazy_terms.get(term)
+			if header is not None:
+				header.getContent()
+				node = self.terms.get(term)
+		return node
+
+	def add_hash_source(self, source):
+		"""Add a source to resolve hashed words (see HashSource)."""
+		self.hash_sources.append(source)
+		self.hash_cache = { }
+
+	def resolve_hash(self, word):
+		"""Resolve a hashed word. Terms defined in the document are
+		looked first, including the ones found in delayed bodies, and
+		resolved to a TermRef; then the hash sources are looked in their
+		adding order. Return the node to generate in place of the word
+		or None. The results are memoized."""
+		try:
+			return self.hash_cache[word]
+		except KeyError:
+			pass
+		if word in self.terms or word in self.lazy_terms:
+			res = TermRef(word)
+		else:
+			res = None
+			for source in self.hash_sources:
+				res = source.resolve(word)
+				if res != None:
+					break
+		self.hash_cache[word] = res
+		return res
+
 	def get_label_for(self, node):
 		"""Get the label, if any, for the given node."""
 		if node in self.inv_labels:
 			return self.inv_labels[node]
 		else:
 			return None
+
+
+# visitors
+PRUNE = "prune"
+STOP = "stop"
+END = object()
+DISPATCH = { }
+
+class Visitor:
+	"""Base class of visitors traversing a document tree.
+	
+	For each node, the walk calls the method onCLASS where CLASS is
+	the name of the node class or, if the visitor does not define it,
+	of the first base class (in MRO order) for which the method exists
+	(ending with onNode). After the children of the node have been
+	visited, the method endCLASS is called, looked up the same way.
+	The lookup is done once per couple of visitor and node classes.
+
+	An on method may return PRUNE to avoid visiting the children
+	of the node (the end method is then not called) or STOP to end
+	the walk. An end method may return STOP."""
+
+	def onNode(self, node):
+		return None
+
+	def endNode(self, node):
+		return None
+
+	def get_children(self, node):
+		"""Get the children of a node to visit. The default implementation
+		returns the content of containers."""
+		if isinstance(node, Container):
+			return node.getContent()
+		else:
+			return ()
+
+	def get_dispatch(self, cls):
+		"""Get the pair (on function, end function) for the given node
+		class. A function is None if the visitor does not redefine it.
+		"""
+		try:
+			table = DISPATCH[self.__class__]
+		except KeyError:
+			table = { }
+			DISPATCH[self.__class__] = table
+		try:
+			return table[cls]
+		except KeyError:
+			on = None
+			end = None
+			for base in cls.__mro__:
+				if on is None:
+					on = getattr(self.__class__, "on" + base.__name__, None)
+				if end is None:
+					end = getattr(self.__class__, "end" + base.__name__, None)
+			if on is Visitor.onNode:
+				on = None
+			if end is Visitor.endNode:
+				end = None
+			table[cls] = (on, end)
+			return (on, end)
+
+	def walk(self, node):
+		"""Visit the given node and its descendants in document order.
+		Return STOP if the walk has been stopped, None else."""
+		table = DISPATCH.get(self.__class__)
+		if table is None:
+			self.get_dispatch(node.__class__)
+			table = DISPATCH[self.__class__]
+		get_children = self.get_children
+		stack = [node]
+		pop = stack.pop
+		push = stack.append
+		while stack:
+			node = pop()
+			if node is END:
+				node = pop()
+				if table[node.__class__][1](self, node) is STOP:
+					return STOP
+				continue
+			try:
+				on, end = table[node.__class__]
+			except KeyError:
+				on, end = self.get_dispatch(node.__class__)
+			if on is None:
+				res = None
+			else:
+				res = on(self, node)
+				if res is STOP:
+					return STOP
+			if res is not PRUNE:
+				if end is not None:
+					push(node)
+					push(END)
+				children = get_children(node)
+				if children:
+					stack.extend(reversed(children))
+		return None
+
+
+class Cleaner(Visitor):
+	"""Visitor removing the empty nodes. The bodies of lazy headers
+	are not materialized."""
+
+	def get_children(self, node):
+		if isinstance(node, Container):
+			return node.content
+		else:
+			return ()
+
+	def endContainer(self, node):
+		toremove = [item for item in node.content if item.isEmpty()]
+		for item in toremove:
+			node.remove(item)
@@ -19,11 +19,14 @@
 """Module providing code highlighting facilities."""
 
 import os.path
+import shutil
 import subprocess
 import sys
 
 import thot.doc as doc
 import thot.common as common
+import thot.html as html
+import thot.serial as serial
 
 LANGS=[
   '4gl',
@@ -174,17 +177,50 @@ def getCommand():
 	global checked
 	if not checked:
 		checked = True
-		(id, release) = common.getLinuxDistrib()
-		if id == "LinuxMint":
+		command = shutil.which("highlight")
+		if not command and os.access("/usr/bin/highlight", os.X_OK):
 			command = "/usr/bin/highlight"
-			common.onWarning("LinuxMint detected. Workaround to find 'highlight' command in /usr/bin/")
-		else:
-			command = common.which("highlight")
-			if not command:
-				common.onWarning("no highlight command found: code will not be colored.")
+		if not command:
+			sys.stderr.write("WARNING: no highlight command found: code will not be colored.\n")
 	return command
 	
 
+def runCommand(command, lang, text, type, line):
+	"""Colorize the code with the highlight command and return the
+	result.
+	command -- highlight command
+	lang -- code language
+	text -- text of the code
+	type -- back-end type
+	line -- first line number or None"""
+
+	# other options
+	opts = ""
+	if line != None:
+		opts = opts + " -l"
+		if line != 1:
+			opts = opts + " -m %s" % line
+
+	# perform the command
+	try:
+		cfd = True
+		if os.name == "nt":
+			cfd = False
+		process = subprocess.Popen(
+			['%s -f --syntax=%s %s %s' % (command, lang, BACKS[type], opts)],
+			stdin = subprocess.PIPE,
+			stdout = subprocess.PIPE,
+			close_fds = cfd,
+			shell = True
+		)
+		res, _ = process.communicate(text.encode('utf-8'))
+		return res.decode('utf-8')
+
+	except OSError as e:
+		sys.stderr.write("ERROR: can not call 'highlight'\n")
+		sys.exit(1)
+
+
 def genCode(gen, lang, text, type, line):
 	"""Generate colorized code.
 	gen -- back-end generator
@@ -206,33 +242,9 @@ def genCode(gen, lang, text, type, line):
 				gen.genVerbatim("\n\\end{verbatim}\n")
 			return
 		
-		# other options
-		opts = ""
-		if line != None:
-			opts = opts + " -l"
-			if line != 1:
-				opts = opts + " -m %s" % line
-		
-		# perform the command
-		try:
-			cfd = True
-			if os.name == "nt":
-				cfd = False
-			process = subprocess.Popen(
-				['%s -f --syntax=%s %s %s' % (command, lang, BACKS[type], opts)],
-				stdin = subprocess.PIPE,
-				stdout = subprocess.PIPE,
-				close_fds = cfd,
-				shell = True
-			)
-			res, _ = process.communicate(text.encode('utf-8'))
-			
-			# generate the source
-			gen.genVerbatim(res.decode('utf-8'))
-			
-		except OSError as e:
-			sys.stderr.write("ERROR: can not call 'highlight'\n")
-			sys.exit(1)
+		# generate the source
+		gen.genVerbatim(runCommand(command, lang, text, type, line))
+
 	else:
 		if lang and lang not in LANGS and lang not in unsupported:
 			sys.stderr.write('WARNING: ' + lang + ' unsupported highglight language\n')
@@ -250,7 +262,10 @@ def genCode(gen, lang, text, type, line):
 class Feature(doc.Feature):
 
 	def prepare(self, gen):
-		type = gen.getType()
+		if isinstance(gen, html.Manager):
+			type = 'html'
+		else:
+			type = gen.getType()
 		command = getCommand()
 		if not command:
 			return
@@ -271,7 +286,7 @@ class Feature(doc.Feature):
 				except ValueError as e:
 					pass
 		except subprocess.CalledProcessError as e :
-			common.onWarning("cannot get supported languages from %s, falling back to default list." % command)
+			sys.stderr.write("WARNING: cannot get supported languages from %s, falling back to default list.\n" % command)
 		
 		# build the CSS file
 		if type in CSS_BACKS:
@@ -287,17 +302,18 @@ class Feature(doc.Feature):
 					close_fds = cfd,
 					shell = True
 				)
-				_ = process.communicate("")
+				_ = process.communicate(b"")
 			except OSError as e:
 				sys.stderr.write("ERROR: can not call 'highlight'\n")
 				sys.exit(1)
 
 			# add the file to the style
-			styles = gen.doc.getVar('HTML_STYLES')
+			styles = gen.doc["HTML_STYLES"]
 			if styles:
-				styles += ':'
-			styles += css
-			gen.doc.setVar('HTML_STYLES', styles)
+				styles = str(styles) + ':' + css
+			else:
+				styles = css
+			gen.doc["HTML_STYLES"] = styles
 
 		# build .sty
 		if type == 'latex':
@@ -310,20 +326,23 @@ class Feature(doc.Feature):
 					close_fds = True,
 					shell = True
 				)
-				_ = process.communicate("")
+				_ = process.communicate(b"")
 			except OSError as e:
 				sys.stderr.write("ERROR: can not call 'highlight'\n")
 				sys.exit(1)
 
 			# build the preamble
-			preamble = gen.doc.getVar('LATEX_PREAMBLE')
+			preamble = gen.doc["LATEX_PREAMBLE"]
+			if not preamble:
+				preamble = ""
 			preamble += '\\usepackage{color}\n'
 			preamble += '\\usepackage{alltt}\n'
 			preamble += '\\input {%s}\n' % css
-			gen.doc.setVar('LATEX_PREAMBLE', preamble)
+			gen.doc["LATEX_PREAMBLE"] = preamble
 
 
 FEATURE = Feature()
+serial.register_object("highlight.feature", FEATURE)
 
 class CodeBlock(doc.Block):
 	lang = None
@@ -366,10 +385,29 @@ class CodeBlock(doc.Block):
 			gen.genText(self.toText())
 			gen.genVerbatim('</programlisting>\n')
 		else:
-			common.onWarning('backend %s unsupported for code block' % type)
+			sys.stderr.write('WARNING: backend %s unsupported for code block\n' % type)
 
 	def kind(self):
 		return "listing"
 
 	def numbering(self):
 		return "listing"
+
+
+def gen_code_html(man, node):
+	text = node.toText()
+	command = None
+	if node.lang in LANGS:
+		command = getCommand()
+	elif node.lang and node.lang not in unsupported:
+		sys.stderr.write('WARNING: ' + node.lang + ' unsupported highglight language\n')
+		unsupported.append(node.lang)
+	if command:
+		code = runCommand(command, node.lang, text, 'html', node.line_number)
+	else:
+		code = html.escape_cdata(text)
+	return html.gen_embedded(man, node, "listing",
+		['<pre class="code">\n', code, '</pre>\n'])
+
+serial.register_node("highlight.code", CodeBlock)
+html.register(CodeBlock, gen_code_html)
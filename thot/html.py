@@ -19,9 +19,63 @@
 """Provides generation from Thot to HTML.
 This module is used by a bunch of back-ends."""
 
+import codecs
+
 import thot.common as common
 import thot.doc as doc
 
+SINK_FRAGMENTS = 4096
+
+
+class Sink:
+	"""Output sink collecting the generated text fragments and writing
+	them encoded, by big blocks, to a binary stream. The characters
+	that cannot be encoded are replaced by character references.
+	The blocks are encoded as a single text: a byte order mark, if
+	any, is only written at the start of the stream."""
+
+	def __init__(self, out, encoding = "UTF-8", fragments = SINK_FRAGMENTS):
+		try:
+			self.encoder = codecs.getincrementalencoder(encoding)("xmlcharrefreplace")
+		except LookupError:
+			raise common.BackException("unknown encoding %s" % encoding)
+		self.out = out
+		self.encoding = encoding
+		self.fragments = fragments
+		self.buf = []
+		self.written = 0
+
+	def write(self, text):
+		"""Add a text to the output."""
+		buf = self.buf
+		buf.append(text)
+		if len(buf) >= self.fragments:
+			self.flush()
+
+	def flush(self, final = False):
+		"""Write the collected fragments to the stream. If final is
+		True, the encoding of the text is ended."""
+		if self.buf or final:
+			data = self.encoder.encode("".join(self.buf), final)
+			self.buf.clear()
+			if data:
+				self.out.write(data)
+				self.written += len(data)
+
+	def finish(self):
+		"""Write the collected fragments and end the encoding of the
+		text, without closing the stream."""
+		self.flush(True)
+
+	def close(self):
+		"""Finish the text and close the stream."""
+		self.finish()
+		self.out.close()
+
+	def get_written(self):
+		"""Get the number of bytes written to the stream."""
+		return self.written
+
 
 class Manager:
 	"""Interface linking and friend creation."""
@@ -45,42 +99,89 @@ class Manager:
 		if there is no anchor."""
 		return None
 
+	def get_anchor_ref(self, node, anchor):
+		"""Get the reference to the given anchor put in the page
+		containing the node."""
+		return "#" + anchor
+
+	def get_doc(self):
+		"""Get the generated document."""
+		return None
+
+	def get_friend_ref(self, path):
+		"""Get the reference to a friend file (as returned by
+		add_friend() or new_friend()) from the current output."""
+		return path
+
+	def add_footnote(self, note):
+		"""Record a foot note to generate at the end of the current
+		output (see gen_footnotes()). Return the number of the note
+		in the output or None if the output does not support notes:
+		the note is then ignored."""
+		return None
+
+	def translate(self, text):
+		"""Get the translation of the given text, one of i18n.ID_xxx,
+		i18n.GLYPH_xxx or i18n.CAPTION_xxx. Return None if there is
+		no translation."""
+		return None
+
 	def write(self, text):
 		"""Write the text to output."""
 		pass
 
+	def get_writer(self):
+		"""Get the function used to write text to the output. Managers
+		writing to a sink may return directly the sink function."""
+		return self.write
+
+
+# escaped characters, in replacement order ("&" first)
+ESCAPES = (
+	("&", "&amp;"),
+	("<", "&lt;"),
+	(">", "&gt;"),
+	('"', "&quot;"),
+	("'", "&#x27;")
+)
 
 def escape_cdata(s):
 	"""Escape in the string s characters that are invalid in CDATA
-	of XML text."""
-	return common.escape(s)
+	of XML text. Most texts do not contain any escaped character:
+	they are detected with a cheap test and returned as is. Otherwise,
+	only the characters found are replaced."""
+	if "&" in s or "<" in s or ">" in s or '"' in s or "'" in s:
+		for (c, r) in ESCAPES:
+			if c in s:
+				s = s.replace(c, r)
+	return s
 
 def escape_attr(s):
 	"""Escape in the string s characters that are invalid in attribute
 	of XML elements."""
-	return common.escape(s, True)
+	return escape_cdata(s)
 
 
 def gen_word(man, node):
-	man.write(escape_cdata(node.toText()))
+	return escape_cdata(node.toText())
 
 def gen_container(man, node):
-	for item in node.content:
-		gen(man, item)
+	"""Generate the content of the node."""
+	gen_items(man, node.getContent())
 
 def gen_par(man, node):
-	man.write('<p>\n')
-	gen_container(man, node)
-	man.write('</p>\n')
+	yield '<p>\n'
+	yield from node.content
+	yield '</p>\n'
 
 def gen_header(man, node):
 	level = str(node.getLevel() + 1)
-	man.write('<h' + level + '>')
-	man.write('<a name="' + man.get_ref(node).split('#')[1] + '"></a>')
-	man.write(man.get_number(node))
-	gen_container(man, node.getTitle())
-	man.write('</h' + level + '>\n')
-	gen_container(man, node)
+	yield '<h' + level + '>'
+	yield '<a name="' + man.get_ref(node).split('#')[1] + '"></a>'
+	yield man.get_number(node)
+	yield from node.getTitle().content
+	yield '</h' + level + '>\n'
+	yield from node.getContent()
 
 STYLES = {
 	doc.STYLE_BOLD: 		('<b>', '</b>'),
@@ -95,17 +196,18 @@ STYLES = {
 	doc.STYLE_BIGGER:		('<big>', '</big>'),
 	doc.STYLE_SMALLER:		('<small>', '</small>'),
 	doc.STYLE_CITE:			('<cite>', '</cite>'),
-	doc.STYLE_CODE:			('<code>', '</code>')
+	doc.STYLE_CODE:			('<code>', '</code>'),
+	doc.STYLE_DELETED:		('<del>', '</del>')
 }
 
 def gen_style(man, node):
 	try:
 		open, close = STYLES[node.get_style()]
-		man.write(open)
-		gen_container(man, node)
-		man.write(close)
 	except KeyError:
-		raise common.BackException("unknown style " + node.get_style())
+		raise common.BackException("%s: unknown style %s" % (node.get_location(), node.get_style()))
+	yield open
+	yield from node.content
+	yield close
 
 LISTS = {
 	'ul': ('<ul>\n', '<li>', '</li>\n', '</ul>\n'),
@@ -116,23 +218,316 @@ def gen_list(man, node):
 	try:
 		lo, io, ic, lc = LISTS[node.get_kind()]
 	except KeyError:
-		raise common.BackException("unknown list %s" % node.get_kind())
-	man.write(lo)
+		raise common.BackException("%s: unknown list %s" % (node.get_location(), node.get_kind()))
+	yield lo
+	for item in node.getItems():
+		yield io
+		yield from item.content
+		yield ic
+	yield lc
+
+def gen_open_style(man, node):
+	try:
+		open, close = STYLES[node.style]
+	except KeyError:
+		raise common.BackException("%s: unknown style %s" % (node.get_location(), node.style))
+	yield open
+	yield from node.content
+	yield close
+
+def get_footnote_ids(note, number):
+	"""Get the anchor and the displayed identifier of a foot note
+	with the given number in the output."""
+	if note.kind == doc.FOOTNOTE_EMBED:
+		return (str(number), str(number))
+	else:
+		return (note.ref, note.id)
+
+def gen_footnote(man, node):
+	"""Generate the reference to a foot note. The content of embedded
+	and defined notes is recorded in the manager and generated at the
+	end of the output (see gen_footnotes())."""
+	if node.kind == doc.FOOTNOTE_REF:
+		number = None
+	else:
+		number = man.add_footnote(node)
+		if number is None or node.kind == doc.FOOTNOTE_DEF:
+			return None
+	anchor, id = get_footnote_ids(node, number)
+	anchor = escape_attr(anchor)
+	return '<a class="footnote-ref" name="footnote-ref-' + anchor + \
+		'" href="#footnote-' + anchor + '"><sup>' + escape_cdata(id) + '</sup></a>'
+
+def gen_footnotes(man, notes):
+	"""Generate the content of the given foot notes, as recorded by
+	Manager.add_footnote()."""
+	yield '<div class="footnotes">\n'
+	for (i, note) in enumerate(notes):
+		anchor, id = get_footnote_ids(note, i + 1)
+		anchor = escape_attr(anchor)
+		yield '<p class="footnote"><a name="footnote-' + anchor + \
+			'" href="#footnote-ref-' + anchor + '">' + escape_cdata(id) + '</a> '
+		yield from note.content
+		yield '</p>\n'
+	yield '</div>\n'
+
+def gen_link(man, node):
+	yield '<a href="' + escape_attr(node.ref) + '">'
+	yield from node.content
+	yield '</a>'
+
+def get_number_text(number):
+	"""Get the text displaying a number: the count of the numbers
+	of embedded nodes ("figure-1", "table-3", ...) or the number
+	itself for headers."""
+	return number.rsplit("-", 1)[-1]
+
+def gen_ref(man, node):
+	target = man.get_doc().get_label(node.label)
+	if target is not None:
+		ref = man.get_ref(target)
+		if ref is not None:
+			return '<a href="' + escape_attr(ref) + '">' + \
+				escape_cdata(get_number_text(man.get_number(target))) + '</a>'
+	raise common.BackException("%s: unresolved reference %s" % (node.get_location(), node.label))
+
+def get_term_anchor(term):
+	"""Get the anchor of the definition of a term."""
+	return "term-" + term
+
+def gen_term_ref(man, node):
+	target = man.get_doc().get_term(node.term)
+	if target is None:
+		return escape_cdata(node.term)
+	ref = man.get_anchor_ref(target, get_term_anchor(node.term))
+	return '<a href="' + escape_attr(ref) + '">' + escape_cdata(node.term) + '</a>'
+
+def gen_tag(man, node):
+	document = node.doc
+	if document is None:
+		document = man.get_doc()
+	if document.get_term(node.tag) is node:
+		return '<a name="' + escape_attr(get_term_anchor(node.tag)) + '"></a>' + \
+			escape_cdata(node.tag)
+	res = document.resolve_hash(node.tag)
+	if res is None:
+		return escape_cdata(node.tag)
+	else:
+		return (res, )
+
+def get_image_ref(man, path):
+	"""Get the reference to an image, imported as a friend file
+	unless it is an URL."""
+	if "://" in path:
+		return path
+	else:
+		return man.get_friend_ref(man.add_friend(path))
+
+def gen_img(man, node, alt):
+	text = '<img src="' + escape_attr(get_image_ref(man, node.path)) + '"'
+	width = node.get_width()
+	if width:
+		text += ' width="%d"' % width
+	height = node.get_height()
+	if height:
+		text += ' height="%d"' % height
+	return text + ' alt="' + escape_attr(alt) + '"/>'
+
+def gen_image(man, node):
+	caption = node.get_caption()
+	return gen_img(man, node, "" if caption is None else caption.toText())
+
+def gen_glyph(man, node):
+	return "&#x%x;" % node.code
+
+def gen_line_break(man, node):
+	return '<br/>'
+
+def gen_horizontal_line(man, node):
+	return '<hr/>\n'
+
+def gen_quote(man, node):
+	yield '<blockquote>\n'
+	yield from node.content
+	yield '</blockquote>\n'
+
+def gen_embedded(man, node, cls, items):
+	"""Generate an embedded node in a division of the given class,
+	made of its anchor, if it is numbered, of the items and of its
+	caption."""
+	yield '<div class="' + cls + '">\n'
+	ref = man.get_ref(node)
+	if ref is not None:
+		yield '<a name="' + escape_attr(ref.split('#')[1]) + '"></a>'
+	yield from items
+	number = man.get_number(node)
+	caption = node.get_caption()
+	if number is not None or caption is not None:
+		yield '<div class="caption">'
+		if number is not None:
+			# numbering kinds are the i18n.CAPTION_xxx identifiers
+			label = man.translate(node.numbering())
+			if label:
+				yield escape_cdata(label % get_number_text(number))
+		if caption is not None:
+			yield from caption.getContent()
+		yield '</div>\n'
+	yield '</div>\n'
+
+def gen_block(man, node):
+	items = ['<pre>\n']
+	for line in node.content:
+		items.append(escape_cdata(line + "\n"))
+	items.append('</pre>\n')
+	return gen_embedded(man, node, "block", items)
+
+ALIGNS = {
+	doc.ALIGN_LEFT:		'left',
+	doc.ALIGN_CENTER:	'center',
+	doc.ALIGN_RIGHT:	'right',
+	doc.ALIGN_JUSTIFY:	'justify'
+}
+
+def gen_figure(man, node):
+	cls = "figure"
+	align = node.get_align()
+	if align in ALIGNS:
+		cls += " " + ALIGNS[align]
+	return gen_embedded(man, node, cls, [gen_img(man, node, "")])
+
+CELLS = [ 'td', 'th' ]
+
+def gen_table_body(man, node):
+	yield '<table>\n'
+	for row in node.getRows():
+		yield '<tr>\n'
+		for cell in row.getCells():
+			tag = CELLS[cell.kind]
+			yield '<' + tag + ' align="' + doc.TABLE_ALIGNS[cell.get_align() + 1] + '"'
+			span = cell.get_hspan()
+			if span != 1:
+				yield ' colspan="%d"' % span
+			span = cell.get_vspan()
+			if span != 1:
+				yield ' rowspan="%d"' % span
+			yield '>'
+			yield from cell.content
+			yield '</' + tag + '>\n'
+		yield '</tr>\n'
+	yield '</table>\n'
+
+def gen_table(man, node):
+	return gen_embedded(man, node, "table", gen_table_body(man, node))
+
+def gen_def_list(man, node):
+	yield '<dl>\n'
 	for item in node.getItems():
-		man.write(io)
-		gen_container(man, item)
-		man.write(ic)
-	man.write(lc)
+		yield '<dt>'
+		yield from item.get_term().content
+		yield '</dt>\n<dd>'
+		yield from item.get_def().content
+		yield '</dd>\n'
+	yield '</dl>\n'
+
+def gen_node(man, node):
+	"""Default handler: generate the content of a container without
+	markup. Other nodes have no HTML generation."""
+	if isinstance(node, doc.Container):
+		return node.getContent()
+	raise common.BackException("%s: no HTML generation for %s"
+		% (node.get_location(), node.__class__.__name__))
 
 MAP = {
-	doc.Header:	gen_header,
-	doc.List:	gen_list,
-	doc.Style:	gen_style,
-	doc.Par:	gen_par,
-	doc.Word:	gen_word
+	doc.DefList:		gen_def_list,
+	doc.Figure:			gen_figure,
+	doc.Block:			gen_block,
+	doc.FootNote:		gen_footnote,
+	doc.Glyph:			gen_glyph,
+	doc.Header:			gen_header,
+	doc.HorizontalLine:	gen_horizontal_line,
+	doc.Image:			gen_image,
+	doc.LineBreak:		gen_line_break,
+	doc.Link:			gen_link,
+	doc.List:			gen_list,
+	doc.OpenStyle:		gen_open_style,
+	doc.Quote:			gen_quote,
+	doc.Ref:			gen_ref,
+	doc.Style:			gen_style,
+	doc.Table:			gen_table,
+	doc.Tag:			gen_tag,
+	doc.TermRef:		gen_term_ref,
+	doc.Par:			gen_par,
+	doc.Word:			gen_word
 }
+HANDLERS = { }
+
+def register(cls, handler):
+	"""Record a handler to generate the nodes of the given class (and
+	of its sub-classes without their own handler). The handler takes
+	the manager and the node and returns None, a string or an iterable
+	of strings and nodes."""
+	MAP[cls] = handler
+	HANDLERS.clear()
+
+def resolve(cls):
+	"""Find the handler of a node class, following the MRO of the class
+	and falling back to gen_node(), and cache it."""
+	for base in cls.__mro__:
+		try:
+			handler = MAP[base]
+			break
+		except KeyError:
+			pass
+	else:
+		handler = gen_node
+	HANDLERS[cls] = handler
+	return handler
+
+def gen_items(man, items):
+	"""Generate the given sequence of nodes. The handlers (see register())
+	return None, a string or an iterable of strings, written as is,
+	and of nodes, generated in turn: the generation uses an explicit
+	stack and does not recurse whatever the depth of the document.
+	
+	Adjacent words generated by gen_word() are gathered in a run
+	escaped and written in one call before any other output."""
+	write = man.get_writer()
+	handlers = HANDLERS
+	run = None
+	stack = [iter(items)]
+	while stack:
+		for item in stack[-1]:
+			cls = item.__class__
+			if cls is str:
+				if run is not None:
+					write(escape_cdata(run))
+					run = None
+				write(item)
+			else:
+				handler = handlers.get(cls)
+				if handler is None:
+					handler = resolve(cls)
+				if handler is gen_word:
+					if run is None:
+						run = item.toText()
+					else:
+						run += item.toText()
+					continue
+				if run is not None:
+					write(escape_cdata(run))
+					run = None
+				res = handler(man, item)
+				if res.__class__ is str:
+					write(res)
+				elif res is not None:
+					stack.append(iter(res))
+					break
+		else:
+			stack.pop()
+	if run is not None:
+		write(escape_cdata(run))
 
 def gen(man, node):
-	"""Generate the given node to the output, possibly using."""
-	MAP[node.__class__](man, node)
+	"""Generate the given node to the output."""
+	gen_items(man, (node, ))
 
@@ -0,0 +1,145 @@
+#
+# Thot2 -- document generator
+# Copyright (C) 2009  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Manifest of the files generated by a back-end.
+
+The manifest records, for each generated file, the hash and the size
+of its content. It is stored as a text file next to the output, with
+one line "HASH SIZE PATH" per file, the path being relative to the
+manifest directory. When a file is generated again with the same
+content, it does not need to be written: its modification time is
+kept. The files of the previous manifest that are not generated
+anymore are removed."""
+
+import hashlib
+import os
+import os.path
+
+import thot.common as common
+
+
+def digest(data):
+	"""Compute the hash of the given bytes."""
+	return hashlib.blake2b(data, digest_size = 16).hexdigest()
+
+
+class Entry:
+	"""Entry of a manifest.
+	* path -- absolute path of the file,
+	* hash -- hash of the content,
+	* size -- size of the content in bytes,
+	* written -- True if the file has been written by this build."""
+
+	def __init__(self, path, hash, size, written = True):
+		self.path = path
+		self.hash = hash
+		self.size = size
+		self.written = written
+
+
+class Manifest:
+	"""Manifest of the generated files. The previous entries are read
+	from the manifest file, if any, and the entries of the current
+	build are collected with add()."""
+
+	def __init__(self, path):
+		self.path = path
+		self.dir = os.path.dirname(os.path.abspath(path))
+		self.old = { }
+		self.new = { }
+		self.load()
+
+	def load(self):
+		"""Read the previous entries from the manifest file. A missing
+		or damaged manifest is ignored: all files are written."""
+		try:
+			with open(self.path, encoding = "UTF-8") as input:
+				for line in input:
+					hash, size, path = line.rstrip("\n").split(" ", 2)
+					path = os.path.join(self.dir, path)
+					self.old[path] = Entry(path, hash, int(size), False)
+		except (OSError, ValueError):
+			self.old = { }
+
+	def is_unchanged(self, path, hash, size):
+		"""Test if the file at the given path already exists with
+		the given content hash and size."""
+		entry = self.old.get(os.path.abspath(path))
+		if entry is None or entry.hash != hash or entry.size != size:
+			return False
+		try:
+			return os.path.getsize(path) == size
+		except OSError:
+			return False
+
+	def write(self, path, data):
+		"""Write the data to the file of the given path unless it is
+		unchanged. Return the entry of the file."""
+		hash = digest(data)
+		if self.is_unchanged(path, hash, len(data)):
+			entry = Entry(os.path.abspath(path), hash, len(data), False)
+		else:
+			try:
+				with open(path, "wb") as out:
+					out.write(data)
+			except OSError as e:
+				raise common.BackException(str(e))
+			entry = Entry(os.path.abspath(path), hash, len(data))
+		self.add(entry)
+		return entry
+
+	def add(self, entry):
+		"""Add an entry to the current build."""
+		self.new[entry.path] = entry
+
+	def get_entries(self):
+		"""Get the entries of the current build."""
+		return self.new.values()
+
+	def prune(self):
+		"""Remove the files of the previous build that are not part
+		of the current build. Return the list of removed paths."""
+		removed = []
+		for path in self.old:
+			if path not in self.new:
+				try:
+					os.remove(path)
+					removed.append(path)
+				except FileNotFoundError:
+					pass
+				except OSError as e:
+					raise common.BackException(str(e))
+		return removed
+
+	def save(self):
+		"""Write the manifest file with the entries of the current
+		build."""
+		tmp = self.path + ".tmp"
+		try:
+			with open(tmp, "w", encoding = "UTF-8") as out:
+				for entry in sorted(self.new.values(), key = lambda e: e.path):
+					out.write("%s %d %s\n" % (entry.hash, entry.size,
+						os.path.relpath(entry.path, self.dir)))
+			os.replace(tmp, self.path)
+		except OSError as e:
+			raise common.BackException(str(e))
+
+	def close(self):
+		"""Prune the stale files and save the manifest."""
+		self.prune()
+		self.save()
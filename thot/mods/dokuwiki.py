@@ -18,10 +18,13 @@
 
 """Dokuwiki syntax plugin"""
 import re
+import sys
 
 import thot.common as common
 import thot.doc as doc
 import thot.highlight as highlight
+import thot.html as html
+import thot.serial as serial
 import thot.tparser as tparser
 
 def computeDepth(text):
@@ -129,7 +132,7 @@ class FileBlock(doc.Block):
 				gen.genText(line + "\n")
 			gen.genVerbatim('</screen>\n')
 		else:
-			common.onWarning('%s back-end is not supported by file block' % type)
+			sys.stderr.write('WARNING: %s back-end is not supported by file block\n' % type)
 		gen.genEmbeddedEnd(self)
 
 
@@ -158,10 +161,29 @@ class NonParsedBlock(doc.Block):
 				gen.genText(line + "\n")
 			gen.genVerbatim('</para>\n')
 		else:
-			common.onWarning('%s back-end is not supported by file block' % type)
+			sys.stderr.write('WARNING: %s back-end is not supported by file block\n' % type)
 		gen.genEmbeddedEnd(self)
 
 
+def gen_file_html(man, node):
+	items = ['<pre class="file">\n']
+	for line in node.content:
+		items.append(html.escape_cdata(line + "\n"))
+	items.append('</pre>\n')
+	return html.gen_embedded(man, node, "file", items)
+
+def gen_nonparsed_html(man, node):
+	yield '<p>\n'
+	for line in node.content:
+		yield html.escape_cdata(line + "\n")
+	yield '</p>\n'
+
+serial.register_node("dokuwiki.file", FileBlock)
+serial.register_node("dokuwiki.nonparsed", NonParsedBlock)
+html.register(FileBlock, gen_file_html)
+html.register(NonParsedBlock, gen_nonparsed_html)
+
+
 ### code parse ###
 END_CODE = re.compile("^\s*<\/code>\s*$")
 END_FILE = re.compile("^\s*<\/file>\s*$")
@@ -288,8 +310,11 @@ def handlePercent(man, match):
 def handleNewPar(man, match):
 	man.send(doc.ObjectEvent(doc.L_PAR, doc.ID_END, doc.Par()))
 
+def header_level(match):
+	return 6 - len(match.group(1))
+
 def handleHeader(man, match):
-	level = 6 - len(match.group(1))
+	level = header_level(match)
 	title = match.group(2)
 	man.send(doc.ObjectEvent(doc.L_HEAD, doc.ID_NEW, doc.Header(level)))
 	tparser.handleText(man, title)
@@ -338,7 +363,7 @@ def handleRow(man, match):
 	else:
 		kind = doc.TAB_NORMAL
 	row = doc.Row(kind)
-	table.content.append(row)
+	table.append(row)
 	man.send(doc.ObjectEvent(doc.L_PAR, doc.ID_NEW_ROW, table))
 	row = match.group(1)
 	object = None
@@ -373,7 +398,7 @@ def handleRow(man, match):
 		# dump object if required
 		if cell == '' and object:
 			#object.span += 1
-			object.setInfo(doc.INFO_HSPAN, object.getInfo(doc.INFO_HSPAN, 0) + 1)
+			object.set_info(doc.INFO_HSPAN, object.get_info(doc.INFO_HSPAN, 0) + 1)
 			continue
 		if object:
 			man.send(doc.ObjectEvent(doc.L_PAR, doc.ID_NEW_CELL, object))
@@ -445,10 +470,10 @@ __words__ = [
 	(lambda man, match: handleCloseStyle(man, "superscript"),
 		"<\/sup>",
 		"""close superscript text."""),
-	(lambda man, match: handleOpenStyle(man, "deleted"),
+	(lambda man, match: handleOpenStyle(man, doc.STYLE_DELETED),
 		"<del>",
 		"""open deleted text."""),
-	(lambda man, match: handleCloseStyle(man, "deleted"),
+	(lambda man, match: handleCloseStyle(man, doc.STYLE_DELETED),
 		"<\/del>",
 		"""close deleted text."""),
 	(handleFootNote,
@@ -486,9 +511,11 @@ __words__ = [
 		"""non-parsed text area"""),
 ]
 
+HEADER_RE = "^(?P<pref>={1,6})(.*)(?P=pref)"
+
 __lines__ = [
 	(handleHeader,
-		"^(?P<pref>={1,6})(.*)(?P=pref)",
+		HEADER_RE,
 		"""section header which level is inversely proportional to the number of '='."""),
 	(handleNewPar,
 		"^$",
@@ -528,6 +555,10 @@ __lines__ = [
 		"""insertion of an image as a a figure with possible width, height, label and aligned according spaces at left or at right.""")
 ]
 
+__headers__ = [
+	(header_level, HEADER_RE)
+]
+
 def init(man):
 	man.defs = { }
 
@@ -0,0 +1,268 @@
+#
+# Thot2 -- document generator
+# Copyright (C) 2009  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Numbering of the document nodes shared by the back-ends.
+
+Headers are numbered according to their position in the outline
+("1", "1.2", ...) and labelled embedded nodes (figures, tables,
+listings) are numbered by kind ("figure-1", "table-3", ...).
+The assignment of the numbered nodes to output pages is delegated
+to a Pager object.
+
+Results are stored in arrays indexed by the node identifiers and
+are cached in the document, so that a document generated several
+times with the same pager is only numbered once.
+
+In a lazy document (see tparser.Manager), the bodies of the top-level
+headers may not be built yet. If the pager only starts pages at the
+top-level headers, the known outline is enough to dispatch the pages:
+the bodies are left as is and the headers they contain are numbered
+when they are first requested, that is, when a page renders the body.
+Otherwise, the delayed bodies are built first. As the labelled embedded
+nodes are numbered in document order, the first request of one of them
+builds the whole document."""
+
+from array import array
+
+import thot.doc as doc
+
+
+class Pager:
+	"""A pager decides how numbered nodes are dispatched in pages.
+	The default pager puts everything in a single page."""
+
+	def __init__(self, path):
+		self.path = path
+
+	def get_key(self):
+		"""Get a key identifying the pager (used to cache numberings)."""
+		return (self.__class__.__name__, self.path)
+
+	def get_page_level(self):
+		"""Get the deepest level of the headers that may start a page.
+		Return None if it is not known: the whole outline is then
+		required to dispatch the pages."""
+		return None
+
+	def get_main(self):
+		"""Get the path of the main page, that is, the page containing
+		the document itself."""
+		return self.path
+
+	def get_page(self, entry, nums, index):
+		"""Called for each header to test if it starts a new page.
+		entry -- header index entry of the header,
+		nums -- list of header numbers,
+		index -- index the page will get if it is created.
+		Return the path of the new page or None if the header
+		is put in the same page as its parent."""
+		return None
+
+
+class Numbering:
+	"""Numbering of a document for a particular pager. The page
+	views (see thot.pages) are built on demand and kept in views."""
+	views = None
+
+	def __init__(self, doc, pager):
+		self.doc = doc
+		self.pager = pager
+		level = pager.get_page_level()
+		if level is None or level > 0:
+			doc.materialize()
+		count = doc.get_node_count()
+		self.numbers = [None] * count
+		self.pages = array('i', [-1]) * count
+		self.page_paths = [pager.get_main()]
+		self.page_nodes = [doc]
+		self.embedded = False
+		self.number_headers(doc.get_headers())
+		if doc.is_materialized():
+			self.number_embedded()
+
+	def extend(self):
+		"""Extend the arrays to the nodes created since the numbering
+		(by the building of delayed bodies)."""
+		n = self.doc.get_node_count() - len(self.numbers)
+		if n > 0:
+			self.numbers.extend([None] * n)
+			self.pages.extend(array('i', [-1]) * n)
+
+	def number_headers(self, entries, root = None):
+		"""Number the given header entries, in document order, and
+		build the pages. If root is given, the entries are the
+		descendants of this already numbered entry."""
+		numbers = self.numbers
+		pages = self.pages
+		depths = { }
+		counts = { }
+		nums = []
+		if root is not None:
+			nums = [int(n) for n in numbers[root.node.node_id].split(".")]
+			depths[root] = len(nums) - 1
+		for entry in entries:
+
+			# compute the numbers
+			parent = entry.parent
+			if parent is None:
+				depth = 0
+				page = 0
+			else:
+				depth = depths[parent] + 1
+				page = pages[parent.node.node_id]
+			depths[entry] = depth
+			n = counts.get(parent, 0) + 1
+			counts[parent] = n
+			del nums[depth:]
+			nums.append(n)
+
+			# compute the page
+			path = self.pager.get_page(entry, nums, len(self.page_paths))
+			if path != None:
+				page = len(self.page_paths)
+				self.page_paths.append(path)
+				self.page_nodes.append(entry.node)
+
+			# record it
+			id = entry.node.node_id
+			numbers[id] = ".".join([str(i) for i in nums])
+			pages[id] = page
+
+	def number_body(self, entry):
+		"""Number the headers of the body of a top-level header built
+		after the numbering."""
+		self.extend()
+		headers = self.doc.get_headers()
+		self.number_headers(headers[entry.index + 1:entry.end], entry)
+
+	def number_embedded(self):
+		"""Number the labelled embedded nodes, in document order.
+		The delayed bodies are built and numbered first."""
+		self.embedded = True
+		self.doc.materialize()
+		self.extend()
+		headers = self.doc.get_headers()
+		for entry in self.doc.get_header_children(None):
+			if entry.end > entry.index + 1 \
+			and self.numbers[headers[entry.index + 1].node.node_id] is None:
+				self.number_body(entry)
+		nodes = []
+		for node in self.doc.labels.values():
+			kind = node.numbering()
+			if kind == None or kind == "header":
+				continue
+			header = node.parent
+			while header is not None and not isinstance(header, doc.Header):
+				header = header.parent
+			if header is None:
+				nodes.append((-1, node.node_id, kind, 0, node))
+			else:
+				nodes.append((header.header_entry.index, node.node_id, kind,
+					self.pages[header.node_id], node))
+		nodes.sort(key = lambda t: t[:2])
+		others = { }
+		for (_, id, kind, page, node) in nodes:
+			n = others.get(kind, 0) + 1
+			others[kind] = n
+			self.numbers[id] = "%s-%d" % (kind, n)
+			self.pages[id] = page
+
+	def number_node(self, node):
+		"""Called for a node without number: if the node is a header
+		of a body built after the numbering or a labelled embedded node
+		not numbered yet, number it. Return True if the node may have
+		got a number."""
+		if node.node_id is None:
+			return False
+		if isinstance(node, doc.Header):
+			entry = node.header_entry
+			if entry is None:
+				return False
+			while entry.parent is not None:
+				entry = entry.parent
+			self.number_body(entry)
+			return True
+		elif not self.embedded and self.doc.get_label_for(node) is not None:
+			self.number_embedded()
+			return True
+		else:
+			return False
+
+	def get_number(self, node):
+		"""Get the number of a node. Return None if the node is not
+		numbered."""
+		try:
+			number = self.numbers[node.node_id]
+		except (IndexError, TypeError):
+			number = None
+		if number is None and self.number_node(node):
+			number = self.numbers[node.node_id]
+		return number
+
+	def get_anchor(self, node):
+		"""Get the anchor identifying the node in its page.
+		Return None if the node is not numbered."""
+		return self.get_number(node)
+
+	def get_page(self, node):
+		"""Get the index of the page containing the node. Return None
+		if the node is not numbered."""
+		try:
+			page = self.pages[node.node_id]
+		except (IndexError, TypeError):
+			page = -1
+		if page < 0:
+			if not self.number_node(node):
+				return None
+			page = self.pages[node.node_id]
+			if page < 0:
+				return None
+		return page
+
+	def get_page_path(self, index):
+		"""Get the path of the page with the given index."""
+		return self.page_paths[index]
+
+	def get_page_node(self, index):
+		"""Get the node (header or document) starting the page with
+		the given index."""
+		return self.page_nodes[index]
+
+	def get_page_count(self):
+		"""Get the number of pages."""
+		return len(self.page_paths)
+
+	def get_ref(self, node):
+		"""Get the reference to a node as "PATH#ANCHOR". Return None
+		if the node is not numbered."""
+		page = self.get_page(node)
+		if page == None:
+			return None
+		return "%s#%s" % (self.page_paths[page], self.numbers[node.node_id])
+
+
+def get_numbering(doc, pager):
+	"""Get the numbering of the document for the given pager.
+	The numbering is only computed the first time it is requested."""
+	key = pager.get_key()
+	try:
+		return doc.numberings[key]
+	except KeyError:
+		numbering = Numbering(doc, pager)
+		doc.numberings[key] = numbering
+		return numbering
@@ -0,0 +1,103 @@
+#
+# Thot2 -- document generator
+# Copyright (C) 2009  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Page views for page-oriented back-ends.
+
+A page view stands for a page of a numbering (see thot.numbering):
+it refers to the node starting the page (the document or a header),
+to the enclosing headers, to the parent and children pages and to the
+previous and next pages. The body of a page is the part of the node
+content preceding the first child page: it is provided as an iterator
+over the content, without copy.
+
+The views are built once for a numbering and kept with it."""
+
+import itertools
+
+
+class PageView:
+	"""View on a page.
+	* index -- index of the page in the numbering,
+	* node -- node starting the page (document or header),
+	* path -- output path of the page,
+	* headers -- tuple of the headers from the top of the document
+	  to the node (empty for the document),
+	* parent -- parent page view (None for the main page),
+	* children -- list of the child page views,
+	* prev, next -- previous and next page views in document order."""
+
+	def __init__(self, index, node, path, parent):
+		self.index = index
+		self.node = node
+		self.path = path
+		self.parent = parent
+		self.children = []
+		self.prev = None
+		self.next = None
+		self.body_end = None
+		if node.parent is None:
+			self.headers = ()
+		else:
+			self.headers = tuple(node.get_path())
+
+	def get_body(self):
+		"""Get an iterator on the nodes of the content of the page
+		node that are not part of a child page."""
+		return itertools.islice(self.node.getContent(), self.body_end)
+
+	def __str__(self):
+		return "page(%d, %s)" % (self.index, self.path)
+
+
+def build_views(numbering):
+	"""Build the page views of a numbering."""
+	views = []
+	for i in range(0, numbering.get_page_count()):
+		node = numbering.get_page_node(i)
+		if i == 0:
+			parent = None
+		else:
+			page = numbering.get_page(node.parent)
+			if page is None:
+				parent = views[0]
+			else:
+				parent = views[page]
+		view = PageView(i, node, numbering.get_page_path(i), parent)
+		if parent is not None:
+			parent.children.append(view)
+		if views:
+			view.prev = views[-1]
+			views[-1].next = view
+		views.append(view)
+
+	# find the end of the bodies
+	for view in views:
+		if view.children:
+			child = view.children[0].node
+			while child.parent is not view.node:
+				child = child.parent
+			view.body_end = view.node.getContent().index(child)
+	return views
+
+
+def get_views(numbering):
+	"""Get the page views of a numbering, built the first time they
+	are requested."""
+	if numbering.views is None:
+		numbering.views = build_views(numbering)
+	return numbering.views
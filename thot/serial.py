@@ -0,0 +1,611 @@
+#
+# Thot2 -- document generator
+# Copyright (C) 2009  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Binary serialization of parsed documents.
+
+The stream starts with the magic MAGIC, a version byte and the list
+of modules used by the document. Then the document is stored as
+a sequence of tagged values:
+* scalars (None, booleans, integers as zig-zag varints, floats),
+* strings, stored once in a string table and then referenced
+  by their index,
+* lists, tuples, dictionaries and arrays (little-endian items),
+* nodes, made of a shape and of the values of their attributes;
+  the shape (kind name and attribute names) is stored the first time
+  it is used and then referenced by its index; a node already stored
+  is only referenced by its index,
+* named objects (like features) and modules.
+
+Node classes are identified by kind names recorded with
+register_node() and not by their import path: modules defining
+their own nodes have to record them. The modules listed in the
+header are loaded before the nodes are read back.
+
+Parse-time indexes (identifier table, header index, etc) are not
+stored but rebuilt when the document is loaded."""
+
+from array import array
+import io
+import itertools
+import struct
+import sys
+import types
+
+import thot.common as common
+import thot.doc as doc
+
+MAGIC = b"THOTAST"
+VERSION = 2
+
+T_NONE = 0
+T_TRUE = 1
+T_FALSE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_NEWSTR = 6
+T_LIST = 7
+T_TUPLE = 8
+T_DICT = 9
+T_NODE = 10
+T_REF = 11
+T_OBJECT = 12
+T_MODULE = 13
+T_NEWNODE = 14
+T_ARRAY = 15
+
+F_LIST = 0
+F_TUPLE = 1
+F_DICT = 2
+F_NODE = 3
+
+BLOCK_SIZE = 1 << 16
+MARGIN = 64		# bytes available before reading a tag and its varints
+
+TRANSIENT = { "header_entry", "lazy_body" }
+DOC_TRANSIENT = TRANSIENT | { "db", "parent_env", "nodes", "headers",
+	"numberings", "inv_labels", "lazy_terms", "hash_cache",
+	"types", "source_ids" }
+
+FLOAT = struct.Struct("<d")
+
+
+#------ registries ------
+
+KINDS = { }
+KIND_NAMES = { }
+OBJECTS = { }
+OBJECT_NAMES = { }
+
+def register_node(name, cls):
+	"""Record a node class with its kind name."""
+	KINDS[name] = cls
+	KIND_NAMES[cls] = name
+
+def register_object(name, object):
+	"""Record a named object (like a feature) that is stored by name."""
+	OBJECTS[name] = object
+	OBJECT_NAMES[id(object)] = name
+
+for (name, cls) in [
+	("word", doc.Word),
+	("ref", doc.Ref),
+	("tag", doc.Tag),
+	("image", doc.Image),
+	("glyph", doc.Glyph),
+	("linebreak", doc.LineBreak),
+	("style", doc.Style),
+	("openstyle", doc.OpenStyle),
+	("footnote", doc.FootNote),
+	("link", doc.Link),
+	("par", doc.Par),
+	("quote", doc.Quote),
+	("embedded", doc.Embedded),
+	("block", doc.Block),
+	("figure", doc.Figure),
+	("listitem", doc.ListItem),
+	("list", doc.List),
+	("defitem", doc.DefItem),
+	("deflist", doc.DefList),
+	("cell", doc.Cell),
+	("row", doc.Row),
+	("table", doc.Table),
+	("hline", doc.HorizontalLine),
+	("header", doc.Header),
+	("document", doc.Document)
+]:
+	register_node(name, cls)
+
+
+#------ writing ------
+
+class Writer:
+	"""Write a document to a binary stream."""
+
+	def __init__(self, out):
+		self.out = out
+		self.buf = bytearray()
+		self.strings = { }
+		self.shapes = { }
+		self.nodes = { }
+
+	def flush(self):
+		"""Write the buffered bytes to the output."""
+		self.out.write(self.buf)
+		del self.buf[:]
+
+	def write_varint(self, n):
+		buf = self.buf
+		while n > 0x7f:
+			buf.append((n & 0x7f) | 0x80)
+			n >>= 7
+		buf.append(n)
+
+	def write_string(self, s):
+		i = self.strings.get(s)
+		if i is None:
+			self.strings[s] = len(self.strings)
+			b = s.encode("utf-8")
+			self.buf.append(T_NEWSTR)
+			self.write_varint(len(b))
+			self.buf += b
+		else:
+			self.buf.append(T_STR)
+			self.write_varint(i)
+
+	def write_node(self, node):
+		"""Write the head of a node not already written and return
+		the list of attribute values to write."""
+		cls = node.__class__
+		try:
+			kind = KIND_NAMES[cls]
+		except KeyError:
+			raise common.ThotException("no kind recorded for %s" % cls.__name__)
+		self.nodes[id(node)] = len(self.nodes)
+		if isinstance(node, doc.Document):
+			skip = DOC_TRANSIENT
+		else:
+			skip = TRANSIENT
+		names = tuple(k for k in node.__dict__ if k not in skip)
+		shape = self.shapes.get((cls, names))
+		if shape is not None:
+			self.buf.append(T_NODE)
+			self.write_varint(shape)
+		else:
+			self.shapes[(cls, names)] = len(self.shapes)
+			self.buf.append(T_NEWNODE)
+			self.write_string(kind)
+			self.write_varint(len(names))
+			for name in names:
+				self.write_string(name)
+		d = node.__dict__
+		return [d[k] for k in names]
+
+	def write_value(self, value):
+		"""Write a value (without recursion)."""
+		buf = self.buf
+		strings = self.strings
+		nodes = self.nodes
+		write_varint = self.write_varint
+		stack = [iter((value, ))]
+		while stack:
+			for v in stack[-1]:
+				c = v.__class__
+
+				# strings
+				if c is str:
+					i = strings.get(v)
+					if i is None:
+						self.write_string(v)
+					else:
+						buf.append(T_STR)
+						if i < 0x80:
+							buf.append(i)
+						else:
+							write_varint(i)
+
+				# scalars
+				elif v is None:
+					buf.append(T_NONE)
+				elif v is True:
+					buf.append(T_TRUE)
+				elif v is False:
+					buf.append(T_FALSE)
+				elif c is int:
+					buf.append(T_INT)
+					write_varint(v << 1 if v >= 0 else ((-v) << 1) - 1)
+				elif c is float:
+					buf.append(T_FLOAT)
+					buf += FLOAT.pack(v)
+
+				# compound values
+				elif c is list or c is tuple:
+					buf.append(T_LIST if c is list else T_TUPLE)
+					write_varint(len(v))
+					if v:
+						stack.append(iter(v))
+						break
+				elif c is dict:
+					buf.append(T_DICT)
+					write_varint(len(v))
+					if v:
+						stack.append(itertools.chain.from_iterable(v.items()))
+						break
+
+				elif c is array:
+					buf.append(T_ARRAY)
+					buf.append(ord(v.typecode))
+					write_varint(len(v))
+					if sys.byteorder == "big":
+						v = array(v.typecode, v)
+						v.byteswap()
+					buf += v.tobytes()
+
+				# nodes
+				elif isinstance(v, doc.Node):
+					i = nodes.get(id(v))
+					if i is not None:
+						buf.append(T_REF)
+						write_varint(i)
+					else:
+						values = self.write_node(v)
+						if len(buf) >= BLOCK_SIZE:
+							self.flush()
+						if values:
+							stack.append(iter(values))
+							break
+
+				# named objects
+				elif id(v) in OBJECT_NAMES:
+					buf.append(T_OBJECT)
+					self.write_string(OBJECT_NAMES[id(v)])
+				elif isinstance(v, types.ModuleType):
+					buf.append(T_MODULE)
+					self.write_string(v.__name__)
+				else:
+					raise common.ThotException("cannot serialize %s" % v)
+			else:
+				stack.pop()
+
+	def write(self, document):
+		"""Write the given document."""
+		self.buf += MAGIC
+		self.buf.append(VERSION)
+		self.write_varint(len(document.get_uses()))
+		for mod in document.get_uses():
+			self.write_string(mod.__name__)
+		self.write_value(document)
+		self.flush()
+
+
+#------ reading ------
+
+class Reader:
+	"""Read a document from a binary stream. The stream is consumed
+	by blocks of BLOCK_SIZE bytes: only the current block (and the
+	end of the previous one) is kept in memory."""
+
+	def __init__(self, input, db):
+		self.input = input
+		self.data = b""
+		self.pos = 0
+		self.end = 0
+		self.base = 0
+		self.db = db
+		self.strings = []
+		self.shapes = []
+		self.nodes = []
+		self.modules = { }
+
+	def fill(self, n):
+		"""Make at least n bytes available from the current position,
+		unless the end of the stream is reached."""
+		data = self.data[self.pos:]
+		self.base += self.pos
+		self.pos = 0
+		while len(data) < n:
+			block = self.input.read(max(BLOCK_SIZE, n - len(data)))
+			if not block:
+				break
+			data += block
+		self.data = data
+		self.end = len(data)
+
+	def need(self, n):
+		"""Make n bytes available from the current position."""
+		if self.pos + n > self.end:
+			self.fill(n)
+
+	def read_varint(self):
+		"""Read a varint: MARGIN bytes must be available (see need())."""
+		data = self.data
+		pos = self.pos
+		b = data[pos]
+		pos += 1
+		n = b & 0x7f
+		shift = 7
+		while b & 0x80:
+			b = data[pos]
+			pos += 1
+			n |= (b & 0x7f) << shift
+			shift += 7
+		self.pos = pos
+		return n
+
+	def read_bytes(self, n):
+		"""Read n bytes."""
+		if self.pos + n > self.end:
+			self.fill(n)
+			if n > self.end:
+				raise common.ThotException("truncated binary document")
+		b = self.data[self.pos:self.pos + n]
+		self.pos += n
+		return b
+
+	def read_string(self):
+		self.need(MARGIN)
+		tag = self.data[self.pos]
+		self.pos += 1
+		if tag == T_STR:
+			return self.strings[self.read_varint()]
+		elif tag == T_NEWSTR:
+			s = str(self.read_bytes(self.read_varint()), "utf-8")
+			self.strings.append(s)
+			return s
+		else:
+			raise common.ThotException("string expected at %d" % (self.base + self.pos - 1))
+
+	def read_value(self):
+		"""Read a value (without recursion). The current position is
+		kept in the local pos and only stored in self.pos around the
+		calls to the other reading methods."""
+		strings = self.strings
+		shapes = self.shapes
+		nodes = self.nodes
+		stack = []
+		frame = None
+		data = self.data
+		pos = self.pos
+		end = self.end
+		while True:
+			if pos + MARGIN > end:
+				self.pos = pos
+				self.fill(MARGIN)
+				data = self.data
+				pos = self.pos
+				end = self.end
+			tag = data[pos]
+			pos += 1
+
+			# frequent values with an inlined one-byte varint
+			if tag == T_STR:
+				i = data[pos]
+				pos += 1
+				if i & 0x80:
+					self.pos = pos - 1
+					i = self.read_varint()
+					pos = self.pos
+				v = strings[i]
+			elif tag == T_NODE:
+				i = data[pos]
+				pos += 1
+				if i & 0x80:
+					self.pos = pos - 1
+					i = self.read_varint()
+					pos = self.pos
+				cls, names = shapes[i]
+				v = cls.__new__(cls)
+				nodes.append(v)
+				if names:
+					frame = [F_NODE, [], len(names), names, v]
+					stack.append(frame)
+					continue
+			elif tag == T_REF:
+				i = data[pos]
+				pos += 1
+				if i & 0x80:
+					self.pos = pos - 1
+					i = self.read_varint()
+					pos = self.pos
+				v = nodes[i]
+
+			# scalars
+			elif tag == T_NONE:
+				v = None
+			elif tag == T_TRUE:
+				v = True
+			elif tag == T_FALSE:
+				v = False
+			elif tag == T_INT:
+				n = data[pos]
+				pos += 1
+				if n & 0x80:
+					self.pos = pos - 1
+					n = self.read_varint()
+					pos = self.pos
+				v = -((n + 1) >> 1) if n & 1 else n >> 1
+			elif tag == T_FLOAT:
+				v = FLOAT.unpack_from(data, pos)[0]
+				pos += FLOAT.size
+
+			# compound values
+			elif tag == T_LIST or tag == T_TUPLE or tag == T_DICT:
+				n = data[pos]
+				pos += 1
+				if n & 0x80:
+					self.pos = pos - 1
+					n = self.read_varint()
+					pos = self.pos
+				if tag == T_DICT:
+					f = [F_DICT, [], 2 * n]
+				else:
+					f = [F_LIST if tag == T_LIST else F_TUPLE, [], n]
+				if n != 0:
+					frame = f
+					stack.append(frame)
+					continue
+				v = self.complete(f)
+
+			elif tag == T_NEWNODE:
+				self.pos = pos
+				name = self.read_string()
+				try:
+					cls = KINDS[name]
+				except KeyError:
+					raise common.ThotException("unknown node kind %s" % name)
+				self.need(MARGIN)
+				names = tuple(self.read_string() for i in range(self.read_varint()))
+				shapes.append((cls, names))
+				data = self.data
+				pos = self.pos
+				end = self.end
+				v = cls.__new__(cls)
+				nodes.append(v)
+				if names:
+					frame = [F_NODE, [], len(names), names, v]
+					stack.append(frame)
+					continue
+
+			# other values
+			else:
+				self.pos = pos - 1
+				v = self.read_other()
+				data = self.data
+				pos = self.pos
+				end = self.end
+
+			# pass the value to the enclosing values
+			while True:
+				if frame is None:
+					self.pos = pos
+					return v
+				values = frame[1]
+				values.append(v)
+				frame[2] -= 1
+				if frame[2]:
+					break
+				stack.pop()
+				if frame[0] == F_NODE:
+					v = frame[4]
+					v.__dict__.update(zip(frame[3], values))
+				else:
+					v = self.complete(frame)
+				frame = stack[-1] if stack else None
+
+	def read_other(self):
+		"""Read the values of read_value() that are neither nodes
+		nor compound values: new strings, arrays and named objects."""
+		self.need(MARGIN)
+		tag = self.data[self.pos]
+		self.pos += 1
+		if tag == T_NEWSTR:
+			self.pos -= 1
+			return self.read_string()
+		elif tag == T_ARRAY:
+			v = array(chr(self.data[self.pos]))
+			self.pos += 1
+			v.frombytes(self.read_bytes(self.read_varint() * v.itemsize))
+			if sys.byteorder == "big":
+				v.byteswap()
+			return v
+		elif tag == T_OBJECT:
+			name = self.read_string()
+			try:
+				return OBJECTS[name]
+			except KeyError:
+				raise common.ThotException("unknown object %s" % name)
+		elif tag == T_MODULE:
+			return self.modules[self.read_string()]
+		else:
+			raise common.ThotException("bad tag %d at %d" % (tag, self.base + self.pos - 1))
+
+	def complete(self, frame):
+		"""Build the value of a completed frame."""
+		kind = frame[0]
+		if kind == F_LIST:
+			return frame[1]
+		elif kind == F_TUPLE:
+			return tuple(frame[1])
+		else:
+			items = frame[1]
+			return dict(zip(items[0::2], items[1::2]))
+
+	def read(self):
+		"""Read the document. Truncated or corrupted data raise a
+		ThotException."""
+		try:
+			return self.read_document()
+		except (AttributeError, IndexError, KeyError, TypeError, ValueError, struct.error) as e:
+			raise common.ThotException("corrupted binary document near %d: %s" % (self.base + self.pos, e))
+
+	def read_document(self):
+		"""Read the document (see read())."""
+		self.fill(len(MAGIC) + 1)
+		if self.data[:len(MAGIC)] != MAGIC:
+			raise common.ThotException("not a Thot binary document")
+		self.pos = len(MAGIC)
+		version = self.read_bytes(1)[0]
+		if version != VERSION:
+			raise common.ThotException("unsupported binary document version %d" % version)
+		self.need(MARGIN)
+
+		# load the modules
+		for i in range(0, self.read_varint()):
+			name = self.read_string()
+			mod = common.load_module(name, self.db["THOT_USE_PATH"])
+			if mod == None:
+				raise common.ThotException("cannot load module %s" % name)
+			self.modules[name] = mod
+
+		# read the document
+		document = self.read_value()
+		if not isinstance(document, doc.Document):
+			raise common.ThotException("no document found")
+		document.restore(self.db, self.nodes)
+		return document
+
+
+#------ API ------
+
+def dump(document, out):
+	"""Write the document to the given binary output stream."""
+	document.materialize()
+	Writer(out).write(document)
+
+def dumps(document):
+	"""Get the binary representation of the document as bytes."""
+	out = io.BytesIO()
+	dump(document, out)
+	return out.getvalue()
+
+def load(input, db):
+	"""Read a document from the given binary input stream, consumed
+	by blocks. The document is attached to the given document base."""
+	return Reader(input, db).read()
+
+def loads(data, db):
+	"""Read a document from the given bytes."""
+	return load(io.BytesIO(data), db)
+
+def is_serial(path):
+	"""Test if the file at the given path contains a binary document."""
+	try:
+		with open(path, "rb") as input:
+			return input.read(len(MAGIC)) == MAGIC
+	except OSError:
+		return False
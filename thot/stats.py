@@ -0,0 +1,149 @@
+#
+# Thot2 -- document generator
+# Copyright (C) 2009  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Size and memory statistics of a document (option --stats).
+
+The size of the tree is approximated with sys.getsizeof() applied to
+the nodes, their attribute dictionaries and the strings, lists and
+dictionaries they own. The memory used by each phase (parse, clean,
+generate) is measured with tracemalloc."""
+
+import sys
+import tracemalloc
+
+import thot.doc as doc
+
+SKIP = { "parent", "doc", "header_entry", "lazy_body" }
+
+
+class ClassStats:
+	"""Statistics for a class of nodes."""
+
+	def __init__(self, name):
+		self.name = name
+		self.count = 0
+		self.size = 0
+
+
+class Stats:
+	"""Statistics of a document."""
+
+	def __init__(self):
+		self.phases = []
+		self.phase = None
+		self.classes = { }
+		self.nodes = 0
+		self.text = 0
+		self.infos = 0
+		self.info_entries = 0
+		self.labels = 0
+		self.features = 0
+		self.size = 0
+
+	def start(self, phase):
+		"""Start the measure of a phase."""
+		if not tracemalloc.is_tracing():
+			tracemalloc.start()
+		tracemalloc.reset_peak()
+		self.phase = phase
+
+	def stop(self):
+		"""Stop the measure of the current phase."""
+		current, peak = tracemalloc.get_traced_memory()
+		self.phases.append((self.phase, current, peak))
+		self.phase = None
+
+	def size_of(self, value):
+		"""Compute the size of an attribute value (nodes excluded)."""
+		size = sys.getsizeof(value)
+		if isinstance(value, (list, tuple)):
+			for item in value:
+				if not isinstance(item, doc.Node):
+					size += self.size_of(item)
+		elif isinstance(value, dict):
+			for item in value.values():
+				if not isinstance(item, doc.Node):
+					size += self.size_of(item)
+		return size
+
+	def collect(self, document):
+		"""Collect the statistics on the tree of the document."""
+		self.labels = len(document.labels)
+		self.features = len(document.features)
+		seen = set()
+		stack = list(reversed(document.getContent()))
+		while stack:
+			node = stack.pop()
+			if id(node) in seen:
+				continue
+			seen.add(id(node))
+			self.nodes += 1
+
+			# node size
+			name = node.__class__.__name__
+			try:
+				cstats = self.classes[name]
+			except KeyError:
+				cstats = ClassStats(name)
+				self.classes[name] = cstats
+			size = sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+			for (key, value) in node.__dict__.items():
+				if key in SKIP or isinstance(value, doc.Node):
+					continue
+				size += self.size_of(value)
+			cstats.count += 1
+			cstats.size += size
+			self.size += size
+
+			# text and information
+			if isinstance(node, doc.Word):
+				self.text += len(node.text.encode("utf-8"))
+			if node.info:
+				self.infos += 1
+				self.info_entries += len(node.info)
+
+			# children
+			children = []
+			for (key, value) in node.__dict__.items():
+				if key in SKIP:
+					continue
+				if isinstance(value, doc.Node):
+					children.append(value)
+				elif isinstance(value, (list, tuple)):
+					children.extend(v for v in value if isinstance(v, doc.Node))
+				elif isinstance(value, dict):
+					children.extend(v for v in value.values() if isinstance(v, doc.Node))
+			children.reverse()
+			stack.extend(children)
+
+	def print(self, out = sys.stdout):
+		"""Print the statistics."""
+		out.write("%-20s %10s %12s\n" % ("class", "count", "bytes"))
+		for cstats in sorted(self.classes.values(), key = lambda c: -c.size):
+			out.write("%-20s %10d %12d\n" % (cstats.name, cstats.count, cstats.size))
+		out.write("%-20s %10d %12d\n" % ("total", self.nodes, self.size))
+		out.write("\n")
+		out.write("text bytes: %d\n" % self.text)
+		out.write("info dictionaries: %d (%d entries)\n" % (self.infos, self.info_entries))
+		out.write("labels: %d\n" % self.labels)
+		out.write("features: %d\n" % self.features)
+		if self.phases:
+			out.write("\n")
+			out.write("%-20s %12s %12s\n" % ("phase", "current", "peak"))
+			for (phase, current, peak) in self.phases:
+				out.write("%-20s %12d %12d\n" % (phase, current, peak))
@@ -18,6 +18,7 @@
 
 """Parser classes based on RE."""
 
+import copy
 import os.path
 import re
 import sys
@@ -32,10 +33,10 @@ DEBUG = False
 def handleVar(man, match):
 	id = match.group('varid')
 	val = man.doc[id]
-	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeWord(val)))
+	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, doc.Word(val)))
 
 def handleRef(man, match):
-	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeRef(match.group("ref"))))
+	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, doc.Ref(match.group("ref"))))
 
 def handleDouble(man, match):
 	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, doc.Word("#")))
@@ -44,12 +45,17 @@ def handle_term(man, word):
 	"""Handle a hashed word."""
 	res = doc.Tag(word, man.doc)
 	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, res))
+	return res
 
 def handleSharp(man, match):
 	handle_term(man, match.group("term"))
 
+TERM_DEF = "#\((?P<pterm>[^)\s]+)\)"
+TERM_RE = re.compile(TERM_DEF)
+
 def handleParent(man, match):
-	handle_term(man, match.group("pterm"))
+	term = match.group("pterm")
+	man.doc.add_term(term, handle_term(man, term))
 
 
 __words__ = [
@@ -63,7 +69,7 @@ __words__ = [
 		"##",
 		"""single '#'."""),
 	(handleParent,
-		"#\((?P<pterm>[^)\s]+)\)",
+		TERM_DEF,
 		"""definition of a term."""),
 	(handleSharp,
 		"#(?P<term>\w+)",
@@ -130,7 +136,8 @@ def handleCaption(man, match):
 		man.pop()
 	man.pop()
 	for item in man.iter():
-		if item.setCaption(par):
+		if item.accepts_caption():
+			item.set_caption(par)
 			return
 	raise common.ParseException("caption unsupported here")
 
@@ -138,9 +145,9 @@ def handleCaption(man, match):
 def handleLabel(man, match):
 	for item in man.iter():
 		if item.acceptLabel():
-			man.doc.addLabel(match.group(1), item)
+			man.doc.add_label(match.group(1), item)
 			return
-	common.onWarning(man.message("label %s out of any container" % match.group(1)))
+	man.warn("label %s out of any container" % match.group(1))
 
 
 __lines__ = [
@@ -164,6 +171,8 @@ __lines__ = [
 		"""assignment of a label for references to the previous element.""")
 ]
 INITIAL_LINES = [(f, re.compile(e)) for (f, e, _) in __lines__]
+EAGER_LINES = [(f, e) for (f, e) in INITIAL_LINES
+	if f in (handleAssign, handleUse, handleInclude)]
 
 class Syntax:
 	"""Base class of all syntaxes added to the parser."""
@@ -183,6 +192,12 @@ class Syntax:
 		"""Get the pairs (function, RE) to parse words."""
 		return []
 
+	def get_headers(self):
+		"""Get the pairs (function, RE) recognizing header lines where
+		function takes the match and returns the header level. Used
+		to delimit header bodies in lazy mode."""
+		return []
+
 
 class DefaultParser:
 
@@ -210,8 +225,14 @@ class Manager:
 	added_words = None
 	line_num = None
 	file_name = None
-
-	def __init__(self, document, ui):
+	header_lines = None
+	lazy = False
+	lazy_header = None
+
+	def __init__(self, document, ui, lazy = False):
+		"""Build a manager. In lazy mode, the bodies of the top-level
+		headers are only recorded during the parsing and are parsed when
+		their content is first requested (see LazyBody)."""
 		self.item = document
 		self.doc = document
 		self.parser = DefaultParser()
@@ -220,7 +241,9 @@ class Manager:
 		self.words = INITIAL_WORDS
 		self.added_lines = []
 		self.added_words = []
+		self.header_lines = []
 		self.ui = ui
+		self.lazy = lazy
 
 	def get_doc(self):
 		return self.doc
@@ -245,10 +268,10 @@ class Manager:
 		self.item.onEvent(self, event)
 
 	def iter(self):
-		"""Generate an iterator on the stack of items (from top to bottom)."""
+		"""Generate an iterator on the current item and its ancestors
+		(from top to bottom)."""
 		yield self.item
-		for i in xrange(len(self.items) - 1, -1, -1):
-			yield self.items[i]
+		yield from self.item.get_ancestors()
 	
 	def top(self):
 		"""Return the top item of the element stack."""
@@ -257,7 +280,11 @@ class Manager:
 	def push(self, item):
 		self.items.append(self.item)
 		self.item = item
-		item.setFileLine(self.file_name, self.line_num)
+		self.doc.register(item, self.file_name, self.line_num)
+		if isinstance(item, doc.Header):
+			self.doc.add_header(item)
+			if self.lazy and item.parent is self.doc:
+				self.lazy_header = item
 		if DEBUG:
 			self.debug("push(%s)" % item)
 			self.debug("stack = %s" % self.items)
@@ -290,19 +317,26 @@ class Manager:
 			if line[-1] == '\n':
 				line = line[0:-1]
 			self.parser.parse(self, line)
+			if self.lazy_header is not None:
+				LazyScanner(self, self.lazy_header)
+		if prev_file is not None and isinstance(self.parser, LazyScanner):
+			self.parser.give_up(self)
 		self.line_num = prev_line
 		self.file_name = prev_file
 
 	def reparse(self, str):
 		self.parser.parse(self, str)
 
-	def parse(self, file, name = '<unknown>'):
+	def parse(self, file, name = '<unknown>', clean = True):
+		"""Parse the given file. If clean is False, the cleanup of the
+		document is left to the caller."""
 		try:
 			self.parseInternal(file, name)
 			self.send(doc.Event(doc.L_DOC, doc.ID_END))
-			self.doc.clean()
+			if clean:
+				self.doc.clean()
 		except common.ParseException as e:
-			common.onError(self.message(e))
+			self.error(e)
 
 	def message(self, msg):
 		"""Generate a message prefixed with error line and file."""
@@ -336,18 +370,18 @@ class Manager:
 
 	def warn(self, msg):
 		"""Display a warning with file and line."""
-		common.onWarning(self.message(msg))
+		self.ui.print_warning(self.message(msg))
 
 	def error(self, msg):
 		"""Display an error with file and line."""
-		common.onError(self.message(msg))
+		self.ui.print_error(self.message(msg))
 
 	def use(self, name):
 		"""Use a module in the current parser."""
 		path = self.doc["THOT_USE_PATH"]
 		mod = common.load_module(name, path)
 		if mod == None:
-			common.onError('cannot load module %s' % name)
+			raise common.ParseException('cannot load module %s' % name)
 		if mod in self.doc.get_uses():
 			return
 		self.doc.use(mod)
@@ -362,6 +396,7 @@ class Manager:
 				lines = mod.__lines__
 			if "__words__" in mod.__dict__:
 				words = mod.__words__
+			self.header_lines = []
 			if "__syntaxes__" in mod.__dict__:
 				for s in mod.__syntaxes__:
 					lines = lines + s.get_lines()
@@ -385,6 +420,15 @@ class Manager:
 					for w in s.get_words():
 						self.addWord(w)
 
+		# header lines
+		if "__headers__" in mod.__dict__:
+			for (f, r) in mod.__headers__:
+				self.header_lines.append((f, re.compile(r)))
+		if "__syntaxes__" in mod.__dict__:
+			for s in mod.__syntaxes__:
+				for (f, r) in s.get_headers():
+					self.header_lines.append((f, re.compile(r)))
+
 
 class BlockParser:
 	old = None
@@ -406,3 +450,105 @@ class BlockParser:
 
 
 	
+
+
+class LazyBody:
+	"""Source of a top-level header body whose parsing is delayed
+	until the content of the header is requested. It records the lines
+	of the body together with the syntax in use at this point."""
+
+	def __init__(self, man, header):
+		self.man = man
+		self.header = header
+		self.file_name = man.file_name
+		self.line_num = man.line_num
+		self.lines = list(man.lines)
+		self.words = list(man.words)
+		self.text = []
+
+	def materialize(self):
+		"""Parse the recorded lines to build the header content."""
+		header = self.header
+		header.lazy_body = None
+		document = self.man.doc
+		first = document.get_node_count()
+		numberings = document.numberings
+		man = copy.copy(self.man)
+		man.lazy = False
+		man.lazy_header = None
+		man.parser = DefaultParser()
+		man.item = header
+		man.items = [document]
+		man.lines = self.lines
+		man.words = self.words
+		man.words_re = None
+		man.file_name = self.file_name
+		man.line_num = self.line_num
+		try:
+			for line in self.text:
+				man.line_num += 1
+				man.parser.parse(man, line)
+		except common.ParseException as e:
+			man.error(str(e))
+		header.clean()
+		document.forget_removed(first)
+
+		# the headers of the body do not change the known numbers:
+		# the numberings number them on demand (see thot.numbering)
+		document.numberings = numberings
+
+
+class LazyScanner:
+	"""Parser used in lazy mode to record the body of a top-level
+	header. The scanning stops on a header line of the same or upper
+	level. Lines changing the parsing state (variable definition,
+	module use, inclusion) cannot be delayed: when one is found, the
+	recorded lines are parsed at once and the header is no more lazy.
+
+	As the scanning only looks at header lines, a line looking like
+	a top-level header inside a block (code, no-wiki, etc) ends the
+	body. Variables used in a delayed body get the value they have
+	when the body is materialized.
+
+	The term definitions (#(term)) found in the lines are recorded
+	in the document so that a hashed word naming such a term is
+	resolved without building every body. A definition found inside
+	a block is recorded too: the term is then only known to be
+	undefined when the body is built."""
+	old = None
+	body = None
+
+	def __init__(self, man, header):
+		man.lazy_header = None
+		self.old = man.getParser()
+		self.body = LazyBody(man, header)
+		header.lazy_body = self.body
+		man.setParser(self)
+
+	def parse(self, man, line):
+		for (fun, r) in man.header_lines:
+			match = r.match(line)
+			if match and fun(match) <= self.body.header.header_level:
+				man.setParser(self.old)
+				self.old.parse(man, line)
+				return
+		for (fun, r) in EAGER_LINES:
+			if r.match(line):
+				self.give_up(man)
+				man.parser.parse(man, line)
+				return
+		if "#(" in line:
+			for match in TERM_RE.finditer(line):
+				man.doc.add_lazy_term(match.group("pterm"), self.body.header)
+		self.body.text.append(line)
+
+	def give_up(self, man):
+		"""Parse immediately the recorded lines and stop scanning."""
+		man.setParser(self.old)
+		self.body.header.lazy_body = None
+		line_num = man.line_num
+		man.line_num = self.body.line_num
+		for line in self.body.text:
+			man.line_num += 1
+			man.parser.parse(man, line)
+		man.line_num = line_num